@@ -0,0 +1,225 @@
+"""
+Portfolio analytics over a user's transactions, computed with NumPy.
+
+The transactions are loaded once into columnar arrays and everything else
+(positions, average cost, realized P&L, daily equity, returns) is derived with
+vectorized cumulative operations instead of Python loops over rows. Prices come
+from the transactions themselves: a symbol is valued at its latest trade price,
+unless a closing price (see bars.py) or a more recent price is given.
+"""
+import numpy as np
+
+
+class Trades:
+    """A user's transactions as columnar arrays, in time order."""
+
+    def __init__(self, symbols, shares, prices, times):
+        self.names, self.codes = np.unique(np.asarray(symbols, dtype=str), return_inverse=True)
+        self.shares = np.asarray(shares, dtype=np.int64)
+        self.prices = np.asarray(prices, dtype=np.float64)
+
+        # Times are "YYYY-MM-DD HH:MM:SS", the first 10 characters are the day
+        self.days = np.asarray(times, dtype="U10").astype("datetime64[D]")
+
+    def __len__(self):
+        return len(self.shares)
+
+
+def load(db, u_id):
+    """Load the transactions of the user with a single query."""
+    cursor = db.connection().cursor()
+
+    # Plain tuples are much cheaper than dicts for this many rows
+    cursor.row_factory = None
+    rows = cursor.execute("""SELECT symbol, shares, price, time FROM transactions
+        WHERE id_user=? ORDER BY time, id_tran""", (u_id,)).fetchall()
+    cursor.close()
+
+    # NumPy turns the tuples into columns in one go, keeping only the day of the time
+    columns = np.array(rows, dtype=[("symbol", "U32"), ("shares", "i8"), ("price", "f8"), ("day", "U10")])
+    return Trades(columns["symbol"], columns["shares"], columns["price"], columns["day"])
+
+
+def _group_starts(keys):
+    """Return a boolean array, true where a run of equal (sorted) keys starts."""
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = keys[1:] != keys[:-1]
+    return starts
+
+
+def _group_cumsum(values, starts):
+    """Cumulative sum of integer values, restarting at every group start (exact, as integers don't round)."""
+    totals = np.cumsum(values)
+
+    # Subtract from every total what was summed before its group started
+    first = np.maximum.accumulate(np.where(starts, np.arange(len(values)), 0))
+    return totals - (totals - values)[first]
+
+
+def _linear_scan(scale, added):
+    """
+    Solve value[k] = scale[k] * value[k - 1] + added[k] for every k, with value[-1] = 0.
+
+    A doubling scan: after the pass of step d every element has folded in the d steps
+    before it, so log2(n) vectorized passes cover them all. The scales are between 0
+    and 1 and nothing is divided, so it can't overflow; a scale of 0 starts over.
+    """
+    scale, value = scale.copy(), added.copy()
+    step = 1
+    while step < len(value):
+        value[step:] += scale[step:] * value[:-step]
+        scale[step:] *= scale[:-step]
+        step *= 2
+    return value
+
+
+def positions(trades):
+    """
+    Replay the trades symbol by symbol.
+
+    Returns the order that sorts the trades by symbol (then time), and for every
+    trade in that order the shares held after it, the cost of those shares and the
+    realized P&L of the trade, using average cost like portfolio.py.
+    """
+    order = np.argsort(trades.codes, kind="stable")
+    codes, shares, prices = trades.codes[order], trades.shares[order], trades.prices[order]
+    starts = _group_starts(codes)
+    held = _group_cumsum(shares, starts)
+    before = held - shares
+
+    # A new run starts with each symbol, and after every time its holding went to zero
+    runs = starts | (before <= 0)
+
+    # Buys add their cost. Sells keep the average, so they scale the cost by held / before,
+    # and the cost of what came before a run doesn't carry into it
+    buys = shares > 0
+    added = np.where(buys, shares * prices, 0.0)
+    scale = np.where(buys, 1.0, np.maximum(held, 0) / np.where(before > 0, before, 1))
+    scale[runs] = 0.0
+
+    cost = _linear_scan(scale, added)
+    cost[held <= 0] = 0.0
+
+    # Realized P&L of a sell is what it brought in, minus the part of the cost it took away
+    previous = np.where(runs, 0.0, np.roll(cost, 1))
+    realized = np.where(buys, 0.0, -shares * prices - (previous - cost))
+    return order, held, cost, realized
+
+
+def _cents(amount):
+    """Round an amount of money to cents, dropping the floating point noise (and the sign of zero)."""
+    return round(float(amount), 2) + 0.0
+
+
+def summary(trades):
+    """Per symbol shares held, cost basis, average cost, realized P&L and last trade price."""
+    order, held, cost, realized = positions(trades)
+    codes, prices = trades.codes[order], trades.prices[order]
+
+    # The last trade of every symbol has its current holding and cost
+    last = np.flatnonzero(np.append(codes[1:] != codes[:-1], True))
+    realized = np.bincount(codes, weights=realized, minlength=len(trades.names))
+    return {
+        str(name): {
+            "shares": int(held[i]),
+            "cost": _cents(cost[i]),
+            "avg_cost": float(cost[i] / held[i]) if held[i] > 0 else 0.0,
+            "realized": _cents(realized[code]),
+            "last_price": float(prices[i])
+        }
+        for name, code, i in zip(trades.names, codes[last], last)
+    }
+
+
+def equity(trades, prices=None, closes=None):
+    """
+    Value of the user's holdings, the money they put in it and its time-weighted growth,
+    at the end of every day with trades.
+
+    prices maps symbols to current prices, used for the last day instead of the trade prices.
+    closes maps symbols to dicts of "YYYY-MM-DD" days to closing prices, used instead of the
+    trade prices on the days they cover.
+    """
+    days, day_index = np.unique(trades.days, return_inverse=True)
+    n_days, n_symbols = len(days), len(trades.names)
+
+    # Shares held and last price of every symbol at the end of every day it traded (NaN otherwise)
+    order, held, _, _ = positions(trades)
+    cell = day_index[order] * n_symbols + trades.codes[order]
+    holdings = np.full(n_days * n_symbols, np.nan)
+    marks = np.full(n_days * n_symbols, np.nan)
+
+    # Within a symbol trades are in time order, so the last assignment of a cell is the end of that day
+    holdings[cell] = held
+    marks[cell] = trades.prices[order]
+    holdings, marks = holdings.reshape(n_days, n_symbols), marks.reshape(n_days, n_symbols)
+
+    # Closing prices are a better end of day value than the price of the last trade
+    if closes:
+        labels = days.astype(str)
+        for code, name in enumerate(trades.names):
+            if closes.get(name):
+                column = np.array([closes[name].get(day, np.nan) for day in labels])
+                marks[:, code] = np.where(np.isnan(column), marks[:, code], column)
+
+    # Carry them forward over the days the symbol didn't trade
+    holdings, marks = _fill_forward(holdings), _fill_forward(marks)
+    if prices:
+        marks[-1] = [prices.get(name, mark) for name, mark in zip(trades.names, marks[-1])]
+    value = np.nansum(holdings * marks, axis=1)
+
+    # Money put in (buys) or taken out (sells) every day
+    flows = np.bincount(day_index, weights=trades.shares * trades.prices, minlength=n_days)
+
+    # Daily return without the effect of the flows (Modified Dietz, money put in at the start of
+    # the day and taken out at the end), chained into a growth index
+    previous = np.concatenate(([0.0], value[:-1]))
+    base = previous + np.maximum(flows, 0)
+    returns = np.divide(value - previous - flows, base, out=np.zeros(n_days), where=base > 0)
+    growth = np.cumprod(1 + returns)
+    return {
+        "days": days,
+        "value": value,
+        "invested": np.cumsum(flows),
+        "returns": returns,
+        "growth": growth
+    }
+
+
+def _fill_forward(matrix):
+    """Replace the NaNs of every column with the last number above them (0 if there is none)."""
+    rows = np.where(np.isnan(matrix), 0, np.arange(len(matrix))[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    filled = matrix[rows, np.arange(matrix.shape[1])]
+    return np.nan_to_num(filled, nan=0.0)
+
+
+def analyze(trades, prices=None, closes=None):
+    """Compute the analytics of the trades, as a dict that can be turned into JSON."""
+    if not len(trades):
+        return {"transactions": 0, "twr": 0.0, "max_drawdown": 0.0, "symbols": {}, "allocation": {}, "equity": []}
+
+    symbols = summary(trades)
+    curve = equity(trades, prices, closes)
+
+    # Time-weighted return, and the worst fall of the growth index from a previous peak
+    growth = curve["growth"]
+    drawdown = growth / np.maximum.accumulate(growth) - 1
+
+    # Share of today's value in every symbol, at the given prices or else the last trade ones
+    prices = prices or {}
+    values = {name: row["shares"] * prices.get(name, row["last_price"]) for name, row in symbols.items() if row["shares"]}
+    total = sum(values.values())
+    allocation = {name: value / total for name, value in values.items()} if total else {}
+
+    return {
+        "transactions": len(trades),
+        "twr": round(float(growth[-1] - 1), 10) + 0.0,
+        "max_drawdown": round(float(drawdown.min()), 10) + 0.0,
+        "symbols": symbols,
+        "allocation": allocation,
+        "equity": [
+            {"day": str(day), "value": float(value), "invested": float(invested), "growth": float(g)}
+            for day, value, invested, g in zip(curve["days"], curve["value"], curve["invested"], growth)
+        ]
+    }
@@ -1,85 +1,171 @@
+import analytics
+import atexit
+import click
+import csv
+import hashlib
+import io
+import metrics
 import os
 import re
+import sqlite3
+import threading
 
-from cs50 import SQL
-from flask import Flask, flash, redirect, render_template, request, session, url_for
-from flask_session import Session
-from tempfile import mkdtemp
+from flask import (Blueprint, Flask, Response, current_app, flash, jsonify, redirect, render_template, request, session,
+                   stream_with_context)
 from werkzeug.exceptions import default_exceptions
-from werkzeug.security import check_password_hash, generate_password_hash
-from datetime import datetime
-
-from helpers import apology, login_required, lookup, usd, credit_verify
-
-
-# Ensure environment variable is set
-if not os.environ.get("API_KEY"):
-    raise RuntimeError("API_KEY not set")
-
-# Configure application
-app = Flask(__name__)
-
-# Ensure templates are auto-reloaded
-app.config["TEMPLATES_AUTO_RELOAD"] = True
-
-# Ensure responses aren't cached
-
-
-@app.after_request
-def after_request(response):
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
-    return response
-
-
-# Custom filter
-app.jinja_env.filters["usd"] = usd
-
-
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_FILE_DIR"] = mkdtemp()
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
-
-# Configure CS50 Library to use SQLite database
-db = SQL("sqlite:///finance.db")
-
-# Make sure the necessary tables are created and related
-db.execute("""CREATE TABLE IF NOT EXISTS 'users' (
-    'id' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-    'username' TEXT NOT NULL,
-    'hash' TEXT NOT NULL,
-    'cash' NUMERIC NOT NULL DEFAULT 10000.00 )""")
-
-db.execute("""CREATE TABLE IF NOT EXISTS 'transactions' (
-    'id_tran' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-    'id_user' INTEGER NOT NULL,
-    'symbol' TEXT NOT NULL,
-    'shares' INTEGER NOT NULL,
-    'price' NUMERIC NOT NULL,
-    'time' TEXT NOT NULL,
-    FOREIGN KEY(id_user) REFERENCES users(id))""")
-
-db.execute("""CREATE TABLE IF NOT EXISTS 'stocks' (
-    'id_stock' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-    'id_user' INTEGER NOT NULL,
-    'symbol' TEXT NOT NULL,
-    'amount' INTEGER NOT NULL,
-    FOREIGN KEY(id_user) REFERENCES users(id))""")
+from werkzeug.local import LocalProxy
+
+from bars import BAR_STORE, BarStore
+from credentials import Credentials, CredentialsBusy
+from database import DATABASE, Database
+from helpers import apology, credit_verify, fetch_bars, login_required, lookup, lookup_many, off_quote, on_quote, quote_status, unknown, usd
+from leaderboard import Leaderboard
+from migrations import MIGRATIONS, migrate
+from orders import KINDS, OrderEngine, cancel as cancel_order, place as place_order
+from portfolio import rebuild as rebuild_portfolio
+from providers import QuoteError, ticker
+from refresher import PriceRefresher
+from sessions import SESSION_STORE, SessionStore, SqliteSessionInterface
+from stream import STREAM_SYMBOLS, PriceStream
+from trades import BasketError, TradeError, execute_basket, execute_order
+
+
+# The pages, registered on an app by create_app. Commands stay at the top level (flask ingest-bars...)
+bp = Blueprint("finance", __name__, cli_group=None)
+
+
+class Services:
+    """
+    The database, pools and background threads of an app.
+
+    Nothing is opened or started until the first request (or command) uses it, so
+    creating the app is cheap, and a server preloading it forks its workers before
+    any thread or connection exists. The background threads only start with the
+    first request: a command (flask migrate...) never fills orders as a side effect.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.started = self.serving = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Migrate the database and open it and the stores, once. Returns self."""
+        if self.started:
+            return self
+        with self._lock:
+            if self.started:
+                return self
+            config = self.config
+
+            # Make sure the necessary tables (and their indexes) are created and up to date
+            if config["AUTO_MIGRATE"]:
+                migrate(config["DATABASE"])
+
+            # Every thread gets its own tuned connection to the database
+            self.db = Database(config["DATABASE"])
+
+            # Passwords are hashed and checked in worker processes (started by the first hash),
+            # so logins don't stall the other pages
+            self.credentials = Credentials()
+            atexit.register(self.credentials.shutdown)
+
+            # Live prices pushed to the browsers, polled once for all of them
+            self.price_stream = PriceStream()
+
+            # Price bars kept locally, for valuations over time without calling the API
+            self.bar_store = BarStore(config["BAR_STORE"])
+
+            # Ranking of every user, shared by all the requests of this process
+            self.leaderboard = Leaderboard(self.db)
+
+            # Limit and stop orders, filled by a background thread (see serve) as new prices arrive
+            self.order_engine = OrderEngine(self.db)
+
+            # Keeps the quotes of every held symbol warm in the background, if asked to
+            self.refresher = None
+            if config["QUOTE_REFRESH"]:
+                db = self.db
+                self.refresher = PriceRefresher(lambda: [row["symbol"] for row in db.execute(
+                    "SELECT symbol FROM stocks UNION SELECT symbol FROM orders WHERE status='open'")])
+
+            self.started = True
+        return self
+
+    def serve(self):
+        """Start the background threads, once, for an app serving requests. Returns self."""
+        self.start()
+        if self.serving:
+            return self
+        with self._lock:
+            if self.serving:
+                return self
+            if self.config["ORDER_ENGINE"]:
+                self.order_engine.start()
+                on_quote(self.order_engine.on_price)
+            if self.refresher:
+                self.refresher.start()
+            atexit.register(self.stop)
+            self.serving = True
+        return self
+
+    def stop(self):
+        """Stop the background threads and stop listening to the quotes, until serve is called again."""
+        with self._lock:
+            if not self.serving:
+                return
+            if self.config["ORDER_ENGINE"]:
+                off_quote(self.order_engine.on_price)
+                self.order_engine.stop()
+            if self.refresher:
+                self.refresher.stop()
+            self.serving = False
+
+
+def services():
+    """Return the started services of the current app."""
+    return current_app.extensions["finance"].start()
+
+
+@bp.before_app_request
+def start_background():
+    """Start the background threads with the first request (commands don't make any)."""
+    current_app.extensions["finance"].serve()
+
+
+# The services of the current app, as used by the pages below
+db = LocalProxy(lambda: services().db)
+credentials = LocalProxy(lambda: services().credentials)
+price_stream = LocalProxy(lambda: services().price_stream)
+bar_store = LocalProxy(lambda: services().bar_store)
+leaderboard = LocalProxy(lambda: services().leaderboard)
+order_engine = LocalProxy(lambda: services().order_engine)
+refresher = LocalProxy(lambda: services().refresher)
+
+# Seconds browsers keep versioned static files (their URL changes with their contents)
+STATIC_MAX_AGE = int(os.environ.get("STATIC_MAX_AGE", 365 * 24 * 60 * 60))
+
+# Most orders accepted in a single basket
+BASKET_SIZE = int(os.environ.get("BASKET_SIZE", 100))
+
+# Transactions shown per page of history
+HISTORY_PAGE = int(os.environ.get("HISTORY_PAGE", 50))
 
 # Regex to compare a new password, to ensure it has min 8 chars, a number, a lowercase and an uppercase
 good_pass = re.compile(r"^(?=.*\d)(?=.*[a-z])(?=.*[A-Z]).{8,30}$")
 
 
-@app.route("/")
+@bp.route("/")
 @login_required
 def index():
     """Show portfolio of stocks"""
 
-    # Get the symbols of all the stocks owned by the user
-    rows = db.execute("SELECT symbol, amount FROM stocks WHERE id_user=:u_id", u_id=session["user_id"])
+    # Get the symbols of all the stocks owned by the user, and what they paid for them on average
+    rows = db.execute("""SELECT symbol, amount, avg_cost FROM stocks LEFT JOIN portfolio USING (id_user, symbol)
+        WHERE id_user=:u_id""", u_id=session["user_id"])
+
+    # Price every owned symbol at once, instead of one request after the other
+    quotes = lookup_many(row["symbol"] for row in rows)
 
     # Variable to record the total holdings of user
     total = 0
@@ -87,14 +173,16 @@ def index():
     # for every row (dict) of owned symbols
     for row in rows:
 
-        # We'll query the current price of the matching stock, and NOT yield until we get it
-        result = lookup(row["symbol"])
-        while not result:
-            result = lookup(row["symbol"])
+        # Symbols the API didn't price in time are shown as unavailable, without blocking the page
+        result = quotes.get(row["symbol"].upper())
+        if not result:
+            row["price"] = row["total"] = row["gain"] = None
+            continue
 
-        # Store the price of a single share, and the value of all the stock in the same row (dict)
+        # Store the price of a single share, the value of all the stock and its gain in the same row (dict)
         row["price"] = result["price"]
         row["total"] = row["amount"] * row["price"]
+        row["gain"] = row["total"] - row["amount"] * row["avg_cost"] if row["avg_cost"] is not None else None
 
         # The value of this stock sums up to the total holdings
         total += row["total"]
@@ -102,10 +190,14 @@ def index():
     # Sum to the value of all the stocks the cash, to get the total holdings
     cash = db.execute("SELECT cash FROM users WHERE id=:u_id", u_id=session["user_id"])[0]["cash"]
     total += cash
-    return render_template("index.html", rows=rows, cash=cash, total=total)
+
+    # Gains already cashed in by selling, including stocks the user doesn't have anymore
+    realized = db.execute("SELECT COALESCE(SUM(realized), 0) AS realized FROM portfolio WHERE id_user=:u_id",
+                          u_id=session["user_id"])[0]["realized"]
+    return render_template("index.html", rows=rows, cash=cash, total=total, realized=realized)
 
 
-@app.route("/account")
+@bp.route("/account")
 @login_required
 def account():
     """Show page with utilities related to the user"""
@@ -114,7 +206,7 @@ def account():
     return render_template("account.html")
 
 
-@app.route("/add_cash", methods=["POST"])
+@bp.route("/add_cash", methods=["POST"])
 @login_required
 def add_cash():
     """URL and function to process a cash depositusing a credit card"""
@@ -140,7 +232,7 @@ def add_cash():
 
             # Validate user's password
             h = db.execute("SELECT hash FROM users WHERE id=:u_id", u_id=session["user_id"])[0]["hash"]
-            if check_password_hash(h, password):
+            if credentials.check(h, password)[0]:
 
                 # Add the cash deposited to the user's old cash
                 o_cash = db.execute("SELECT cash FROM users WHERE id=:u_id", u_id=session["user_id"])[0]["cash"]
@@ -161,7 +253,35 @@ def add_cash():
     return redirect("/account")
 
 
-@app.route("/buy", methods=["GET", "POST"])
+def user_analytics(u_id):
+    """Compute the analytics of the user's transactions, valuing what they hold at current prices"""
+    trades = analytics.load(db, u_id)
+    held = [row["symbol"] for row in db.execute("SELECT symbol FROM stocks WHERE id_user=:u_id", u_id=u_id)]
+    prices = {symbol: quote["price"] for symbol, quote in lookup_many(held).items() if quote}
+
+    # Value past holdings at the closing prices stored locally, when there are any
+    closes = {}
+    if len(trades):
+        first, last = str(trades.days[0]), str(trades.days[-1])
+        closes = {symbol: bar_store.daily_closes(symbol, first, last) for symbol in trades.names}
+    return analytics.analyze(trades, prices, closes)
+
+
+@bp.route("/analytics")
+@login_required
+def analytics_page():
+    """Show returns, allocation and gains of the user's portfolio"""
+    return render_template("analytics.html", stats=user_analytics(session["user_id"]))
+
+
+@bp.route("/analytics.json")
+@login_required
+def analytics_json():
+    """Same as /analytics, as JSON (with the full daily equity curve)"""
+    return jsonify(user_analytics(session["user_id"]))
+
+
+@bp.route("/buy", methods=["GET", "POST"])
 @login_required
 def buy():
     """Buy shares of stock"""
@@ -201,45 +321,112 @@ def buy():
 
         symbol, price = result["symbol"], result["price"]
 
-        # Ensure the user can afford the purchase
-        u_id = session["user_id"]
-        cash = db.execute("SELECT cash FROM users WHERE id=:u_id", u_id=u_id)[0]["cash"]
-        if cash < (price * shares):
-            return apology("u poor")
+        # Pay for the shares and add them to the user's stocks, all at once. Fails if the user can't afford it
+        try:
+            execute_order(db, session["user_id"], symbol, shares, price)
+        except TradeError as e:
+            return apology(str(e))
 
-        # If the user has enough money, substract the cost from their cash reserves
-        db.execute("UPDATE users SET cash=:ncash WHERE id=:u_id",
-                   ncash=cash - (price * shares), u_id=u_id)
+        ending = "s" if shares > 1 else ""
+        flash(f"You have successfully purchased {shares} {symbol} share{ending}")
+        return redirect("/")
+
+    # User reached this URL via GET (link, redirect)
+    else:
+        return render_template("buy.html")
 
-        # Register a transaction
-        t = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        db.execute("""INSERT INTO transactions (id_user, symbol, shares, price, time) VALUES
-            (:id_user, :symbol, :shares, :price, :time)""", id_user=u_id, symbol=symbol, shares=shares, price=price, time=t)
 
-        stock = db.execute("SELECT id_stock FROM stocks WHERE id_user=:u_id AND symbol=:symbol", u_id=u_id, symbol=symbol)
+def basket_orders(entries):
+    """
+    Validate the orders of a basket, given as (side, symbol, shares) entries.
 
-        if not stock:
-            # If the user doesn't own share of this stock, register that now he does
-            db.execute("""INSERT INTO stocks (id_user, symbol, amount) VALUES
-                (:u_id, :symbol, :amount)""", u_id=u_id, symbol=symbol, amount=shares)
+    Returns the (symbol, shares) orders, with negative shares for sells, and a result
+    dict for every entry, whose error says why it is invalid (None if it is valid).
+    """
+    orders, results = [], []
+    for side, symbol, shares in entries:
+        symbol = str(symbol or "").strip().upper()
+        side = str(side or "").strip().lower()
+        result = {"side": side, "symbol": symbol, "shares": shares, "price": None, "error": None}
+        results.append(result)
 
+        # Same checks as /buy and /sell, plus the side and a plausible ticker
+        try:
+            shares = int(shares)
+        except (TypeError, ValueError):
+            result["error"] = "enter an integer"
+            continue
+        if side not in ("buy", "sell"):
+            result["error"] = "side must be buy or sell"
+        elif not ticker.fullmatch(symbol):
+            result["error"] = "not symbol"
+        elif not 0 < shares:
+            result["error"] = "not positive shares"
         else:
-            # If the user had shares of this company, add to this amount the recently purchased stock
-            stock = stock[0]["id_stock"]
-            old_amount = db.execute("SELECT amount FROM stocks WHERE id_stock=:stock", stock=stock)[0]["amount"]
-            db.execute("UPDATE stocks SET amount=:namount WHERE id_stock=:stock",
-                       namount=old_amount + shares, stock=stock)
+            result["shares"] = shares
+            orders.append((symbol, shares if side == "buy" else -shares))
+    return orders, results
 
-        ending = "s" if shares > 1 else ""
-        flash(f"You have successfully purchased {shares} {symbol} share{ending}")
-        return redirect("/")
 
-    # User reached this URL via GET (link, redirect)
+@bp.route("/basket", methods=["GET", "POST"])
+@login_required
+def basket():
+    """Buy and sell several stocks at once, all-or-nothing. Takes JSON or a form with one order per line"""
+    if request.method == "GET":
+        return render_template("basket.html")
+
+    # JSON is {"orders": [{"side": "buy", "symbol": "AAPL", "shares": 10}, ...]}, the form has lines like "buy AAPL 10"
+    if request.is_json:
+        payload = request.get_json(silent=True)
+        entries = payload.get("orders") if isinstance(payload, dict) else None
+        if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+            return jsonify({"error": "expected a list of orders"}), 400
+        entries = [(entry.get("side"), entry.get("symbol"), entry.get("shares")) for entry in entries]
     else:
-        return render_template("buy.html")
+        entries = [(line.split() + [None] * 3)[:3] for line in request.form.get("orders", "").splitlines() if line.strip()]
+
+    def respond(message, results, code):
+        """Answer in the format of the request"""
+        if request.is_json:
+            return jsonify({"error": message, "orders": results}), code
+        if message:
+            flash(message)
+        return render_template("basket.html", results=results, orders=request.form.get("orders", "")), code
+
+    # Validate everything before pricing anything
+    if not entries:
+        return respond("no orders", [], 400)
+    if len(entries) > BASKET_SIZE:
+        return respond(f"at most {BASKET_SIZE} orders per basket", [], 400)
+    orders, results = basket_orders(entries)
+    if len(orders) < len(entries):
+        return respond("invalid orders", results, 400)
+
+    # Price every distinct symbol at once. The ones the provider doesn't know are typos, not failures
+    quotes = lookup_many(symbol for symbol, _ in orders)
+    prices = {symbol: quote["price"] for symbol, quote in quotes.items() if quote}
+    missing = {symbol for symbol, quote in quotes.items() if not quote and unknown(symbol)}
+
+    # Check the cash and holdings of the whole basket, then execute it in a single transaction
+    try:
+        executed = execute_basket(db, session["user_id"], orders, prices, missing)
+    except BasketError as e:
+        for result, checked in zip(results, e.results):
+            result["price"], result["error"] = checked["price"], checked["error"]
+
+        # Only a basket that failed for want of prices is worth sending again
+        unpriced = all(result["error"] in (None, "price unavailable") for result in results)
+        return respond(str(e), results, 503 if unpriced else 400)
+
+    for result, done in zip(results, executed):
+        result["price"], result["total"] = done["price"], done["total"]
+    if request.is_json:
+        return jsonify({"error": None, "orders": results})
+    flash(f"You have successfully executed {len(results)} order{'s' if len(results) > 1 else ''}")
+    return redirect("/")
 
 
-@app.route("/change_pass", methods=["POST"])
+@bp.route("/change_pass", methods=["POST"])
 @login_required
 def change_pass():
     """URL and function to process a password change request"""
@@ -257,7 +444,7 @@ def change_pass():
     # Check that the provided (current) password is valid. Compare it to hash
     u_id = session["user_id"]
     h = db.execute("SELECT hash FROM users WHERE id=:u_id", u_id=u_id)[0]["hash"]
-    if check_password_hash(h, o_pass):
+    if credentials.check(h, o_pass)[0]:
 
         # Ensure the user has typed the new password correctly 2 times
         if n_pass == conf:
@@ -266,7 +453,7 @@ def change_pass():
             if good_pass.fullmatch(n_pass):
 
                 # Store the hash based in the new password
-                db.execute("UPDATE users SET hash=:n_pass WHERE id=:u_id", n_pass=generate_password_hash(n_pass), u_id=u_id)
+                db.execute("UPDATE users SET hash=:n_pass WHERE id=:u_id", n_pass=credentials.hash(n_pass), u_id=u_id)
                 message = "Password correctly updated"
 
             else:
@@ -282,17 +469,149 @@ def change_pass():
     return redirect("/account")
 
 
-@app.route("/history")
+@bp.route("/health/quotes")
+def health_quotes():
+    """Report the state of the quote fetching machinery, for monitoring"""
+
+    # The breaker being open means the API is failing, which is worth alerting on
+    status = quote_status()
+    status["stream"] = price_stream.status()
+    status["orders"] = order_engine.status()
+    if refresher:
+        status["refresher"] = refresher.status()
+    return jsonify(status), 503 if status["breaker"]["state"] == "open" else 200
+
+
+def history_query(u_id, args):
+    """
+    Build the query of the user's transactions matching the filters in args, oldest first.
+
+    Filters are symbol, start and end (inclusive dates) and after, the "time,id_tran" of
+    the last transaction already seen. Returns the SQL and its parameters, or None if
+    the filters are invalid.
+    """
+    conditions, params = ["id_user=:u_id"], {"u_id": u_id}
+
+    if args.get("symbol"):
+        conditions.append("symbol=:symbol")
+        params["symbol"] = args["symbol"].upper()
+
+    # Dates are compared as text against the beginning of the day (and the one after the end)
+    for name, condition in [("start", "time >= :start"), ("end", "time < date(:end, '+1 day')")]:
+        if args.get(name):
+            if not re.fullmatch(r"\d{4}-\d{2}-\d{2}", args[name]):
+                return None
+            conditions.append(condition)
+            params[name] = args[name]
+
+    # Keyset pagination: continue right after the last transaction seen, the index makes this a seek
+    if args.get("after"):
+        after_time, _, after_id = args["after"].rpartition(",")
+        if not (after_time and after_id.isdigit()):
+            return None
+        conditions.append("time >= :after_time AND (time > :after_time OR id_tran > :after_id)")
+        params.update(after_time=after_time, after_id=int(after_id))
+
+    sql = f"""SELECT id_tran, symbol, shares, price, time FROM transactions
+        WHERE {" AND ".join(conditions)} ORDER BY time, id_tran"""
+    return sql, params
+
+
+@bp.route("/history")
 @login_required
 def history():
-    """Show history of transactions"""
+    """Show history of transactions, a page at a time"""
+
+    # Filter the transactions as asked by the user
+    query = history_query(session["user_id"], request.args)
+    if not query:
+        return apology("invalid filters")
+    sql, params = query
+
+    # Transactions are only ever added, so the page stays the same until the user's last one changes.
+    # A browser that has it already gets a 304, unless a message waits to be shown
+    last = db.execute("SELECT MAX(id_tran) AS id_tran, COUNT(*) AS count FROM transactions WHERE id_user=:u_id",
+                      u_id=session["user_id"])[0]
+    etag = hashlib.sha1(repr((session["user_id"], last["id_tran"], last["count"], HISTORY_PAGE,
+                              sorted(request.args.items(multi=True)))).encode()).hexdigest()
+    if request.if_none_match.contains(etag) and not session.get("_flashes"):
+        response = Response(status=304)
+    else:
+
+        # Fetch one more than a page, to know whether there is a next one
+        trans = db.execute(sql + " LIMIT :limit", limit=HISTORY_PAGE + 1, **params)
+        after = None
+        if len(trans) > HISTORY_PAGE:
+            trans = trans[:HISTORY_PAGE]
+            after = f"{trans[-1]['time']},{trans[-1]['id_tran']}"
+
+        # Links to other pages and to the CSV keep the current filters
+        filters = {name: request.args[name] for name in ("symbol", "start", "end") if request.args.get(name)}
+        response = Response(render_template("history.html", trans=trans, filters=filters, after=after))
+
+    # Browsers may keep the page, but have to ask whether it changed every time
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
 
-    # Transaction data has been stored, so just pass the query to the template
-    trans = db.execute("SELECT symbol, shares, price, time FROM transactions WHERE id_user=:u_id", u_id=session["user_id"])
-    return render_template("history.html", trans=trans)
+@bp.route("/history.csv")
+@login_required
+def history_csv():
+    """Download the (filtered) history of transactions as CSV"""
+
+    query = history_query(session["user_id"], request.args)
+    if not query:
+        return apology("invalid filters")
+    sql, params = query
+
+    def generate():
+        """Yield the CSV a row at a time, straight from the cursor, so memory doesn't grow with the history."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["symbol", "shares", "price", "time"])
+        for row in db.iterate(sql, **params):
+            writer.writerow([row["symbol"], row["shares"], row["price"], row["time"]])
+
+            # Send the buffered rows every now and then, instead of a tiny chunk per row
+            if buffer.tell() > 8192:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=history.csv"})
+
+
+@bp.route("/leaderboard")
+@login_required
+def leaderboard_page():
+    """Rank every user by total holdings, and show what the whole site trades"""
+    board = leaderboard.get()
+    return render_template("leaderboard.html", board=board, rank=board["ranks"].get(session["user_id"]))
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/stream/prices")
+@login_required
+def stream_prices():
+    """Push the prices of the user's stocks, and of the symbols in ?symbols=A,B, as server-sent events"""
+    symbols = {row["symbol"].upper() for row in db.execute("SELECT symbol FROM stocks WHERE id_user=:u_id",
+                                                              u_id=session["user_id"])}
+    symbols.update(symbol for symbol in request.args.get("symbols", "").upper().split(",") if ticker.fullmatch(symbol))
+    if not symbols:
+        return apology("no symbols to stream")
+    if len(symbols) > STREAM_SYMBOLS:
+        return apology(f"at most {STREAM_SYMBOLS} symbols", 400)
+
+    # Every client holds a connection (and a thread, or a greenlet) until it goes away
+    subscription = price_stream.subscribe(symbols)
+    return Response(stream_with_context(price_stream.events(subscription)), mimetype="text/event-stream",
+                    headers={"X-Accel-Buffering": "no"})
+
+
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     """Log user in"""
 
@@ -315,9 +634,17 @@ def login():
                           username=request.form.get("username"))
 
         # Ensure username exists and password is correct
-        if len(rows) != 1 or not check_password_hash(rows[0]["hash"], request.form.get("password")):
+        if len(rows) != 1:
+            return apology("invalid username and/or password", 403)
+        valid, rehashed = credentials.check(rows[0]["hash"], request.form.get("password"))
+        if not valid:
             return apology("invalid username and/or password", 403)
 
+        # Upgrade a hash made with outdated parameters, unless the password changed meanwhile
+        if rehashed:
+            db.execute("UPDATE users SET hash=:new WHERE id=:u_id AND hash=:old",
+                       new=rehashed, u_id=rows[0]["id"], old=rows[0]["hash"])
+
         # Remember which user has logged in
         session["user_id"] = rows[0]["id"]
 
@@ -329,7 +656,7 @@ def login():
         return render_template("login.html")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     """Log user out"""
 
@@ -340,7 +667,63 @@ def logout():
     return redirect("/")
 
 
-@app.route("/quote", methods=["GET", "POST"])
+@bp.route("/orders", methods=["GET", "POST"])
+@login_required
+def orders():
+    """Place limit and stop orders, and show the user's orders"""
+    u_id = session["user_id"]
+
+    # The user got here through a POST request (form)
+    if request.method == "POST":
+        side, kind = request.form.get("side"), request.form.get("kind")
+        symbol = request.form.get("symbol") or ""
+
+        # Ensure integer shares and a price, both positive
+        try:
+            shares, trigger = int(request.form.get("shares")), float(request.form.get("trigger"))
+        except (TypeError, ValueError):
+            return apology("enter shares and a price")
+        if not (0 < shares and 0 < trigger):
+            return apology("not positive shares or price")
+        if side not in ("buy", "sell") or kind not in KINDS:
+            return apology("choose buy or sell, limit or stop")
+
+        # Only real symbols, and only shares the user has can be sold (checked again when it fills)
+        quote = lookup(symbol)
+        if not quote:
+            return apology("symbol 404")
+        symbol = quote["symbol"]
+        if side == "sell":
+            available = db.execute("SELECT amount FROM stocks WHERE id_user=:u_id AND symbol=:symbol", u_id=u_id, symbol=symbol)
+            if not available or available[0]["amount"] < shares:
+                return apology("you don't have that many")
+
+        # Add it to the book right away, an order the current price already triggers fills now
+        place_order(db, u_id, symbol, shares if side == "buy" else -shares, kind, trigger)
+        order_engine.sync()
+        order_engine.on_price(symbol, quote["price"])
+        flash(f"Your {side} {kind} order for {shares} {symbol} at {usd(trigger)} was placed")
+        return redirect("/orders")
+
+    # User reached this URL via GET (link, redirect)
+    rows = db.execute("""SELECT * FROM orders WHERE id_user=:u_id
+        ORDER BY status != 'open', id_order DESC LIMIT 100""", u_id=u_id)
+    stocks = db.execute("SELECT symbol FROM stocks WHERE id_user=:u_id", u_id=u_id)
+    return render_template("orders.html", orders=rows, stocks=stocks)
+
+
+@bp.route("/orders/<int:id_order>/cancel", methods=["POST"])
+@login_required
+def orders_cancel(id_order):
+    """Cancel an open order of the user"""
+    if not cancel_order(db, session["user_id"], id_order):
+        return apology("no such open order", 404)
+    order_engine.discard(id_order)
+    flash("Your order was cancelled")
+    return redirect("/orders")
+
+
+@bp.route("/quote", methods=["GET", "POST"])
 @login_required
 def quote():
     """Get stock quote."""
@@ -368,7 +751,7 @@ def quote():
         return render_template("quote.html")
 
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     """Adds a user (and their password) to the database"""
 
@@ -399,9 +782,13 @@ def register():
         if rows:
             return apology("already registered")
 
-        # If everything is in order, add the user to the database
-        db.execute("INSERT INTO users (username, hash) VALUES (:u_name, :p_word)",
-                   u_name=username, p_word=generate_password_hash(password))
+        # If everything is in order, add the user to the database. The unique index turns away
+        # whoever registered the same name meanwhile
+        try:
+            db.execute("INSERT INTO users (username, hash) VALUES (:u_name, :p_word)",
+                       u_name=username, p_word=credentials.hash(password))
+        except sqlite3.IntegrityError:
+            return apology("already registered")
         flash('You were successfully registered')
         return redirect("/")
 
@@ -410,7 +797,7 @@ def register():
         return render_template("register.html")
 
 
-@app.route("/sell", methods=["GET", "POST"])
+@bp.route("/sell", methods=["GET", "POST"])
 @login_required
 def sell():
     """Sell shares of stock"""
@@ -446,31 +833,17 @@ def sell():
         if available < shares:
             return apology("you don't have that many")
 
-        # Get the date and time of the transaction
-        t = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # We'll query the current price of the matching stock, and NOT yield until we get it
+        # Query the current price of the matching stock, the API may be down (or the quote late)
         price = lookup(symbol)
-        while not price:
-            price = lookup(symbol)
+        if not price:
+            return apology("price unavailable", 503)
         price = price["price"]
 
-        # Get the current amount of cash the user has
-        old_cash = db.execute("SELECT cash FROM users WHERE id=:u_id", u_id=u_id)[0]["cash"]
-
-        # Register the transaction and add the money from the sell to their existences
-        db.execute("""INSERT INTO transactions (id_user, symbol, shares, price, time) VALUES
-            (:id_user, :symbol, :sh, :price, :t)""", id_user=u_id, symbol=symbol, sh=(-shares), price=price, t=t)
-        db.execute("UPDATE users SET cash=:cash WHERE id=:u_id", cash=old_cash + (shares * price), u_id=u_id)
-
-        if available == shares:
-            # If the user sells all their shares for this stock, delete the register of them having stocks of this company
-            db.execute("DELETE FROM stocks WHERE id_user=:u_id AND symbol=:symbol", u_id=u_id, symbol=symbol)
-
-        else:
-            # Otherwise, just substract from their stocks the amount they sold
-            db.execute("UPDATE stocks SET amount=:amount WHERE id_user=:u_id AND symbol=:symbol",
-                       amount=available - shares, u_id=u_id, symbol=symbol)
+        # Take the shares from the user and pay them, all at once. Fails if the shares were sold meanwhile
+        try:
+            execute_order(db, u_id, symbol, -shares, price)
+        except TradeError as e:
+            return apology(str(e))
 
         ending = "s" if shares > 1 else ""
         flash(f"You successfully sold {shares} {symbol} share{ending}")
@@ -482,6 +855,80 @@ def sell():
         return render_template("sell.html", stocks=stocks)
 
 
+@bp.cli.command("ingest-bars")
+@click.argument("symbols", nargs=-1, required=True)
+@click.option("--full", is_flag=True, help="Fetch the whole history the provider has, not only the latest bars.")
+def ingest_bars_command(symbols, full):
+    """Fetch the 1 minute price bars of SYMBOLS and store them locally."""
+    for symbol in symbols:
+        try:
+            count = bar_store.ingest(symbol, fetch_bars(symbol, full))
+        except (QuoteError, NotImplementedError) as e:
+            click.echo(f"{symbol.upper()}: {e}")
+        else:
+            click.echo(f"{symbol.upper()}: {count} bars stored")
+
+
+@bp.cli.command("rebuild-portfolio")
+@click.option("--user", type=int, help="Only rebuild the portfolio of this user id.")
+def rebuild_portfolio_command(user):
+    """Recompute the portfolio table from the transactions, reporting inconsistencies."""
+    mismatches = rebuild_portfolio(db, user)
+    for u_id, symbol, column, stored, computed in mismatches:
+        click.echo(f"user {u_id} {symbol}: {column} was {stored}, should be {computed}")
+    click.echo(f"Portfolio rebuilt, {len(mismatches)} inconsistencies fixed")
+
+
+@bp.cli.command("migrate")
+def migrate_command():
+    """Bring the database schema up to date, before starting the workers."""
+    database = current_app.config["DATABASE"]
+    version = migrate(database)
+    click.echo(f"{database} migrated from schema version {version}" if version < len(MIGRATIONS)
+               else f"{database} is up to date")
+
+
+# Versions of the static files, by path and modification time
+_static_versions = {}
+
+
+@bp.app_url_defaults
+def static_version(endpoint, values):
+    """Add a hash of the contents to the URLs of static files, so they can be cached for good."""
+    if endpoint != "static" or "filename" not in values or "v" in values:
+        return
+    path = os.path.join(current_app.static_folder, values["filename"])
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except OSError:
+        return
+    if key not in _static_versions:
+        with open(path, "rb") as f:
+            _static_versions[key] = hashlib.sha1(f.read()).hexdigest()[:12]
+    values["v"] = _static_versions[key]
+
+
+@bp.after_app_request
+def cache_policy(response):
+    """Cache versioned static files for good, and nothing else unless the page chose how"""
+
+    # Unversioned static files keep the ETag and no-cache of send_file, so they are revalidated
+    if request.endpoint == "static":
+        if request.args.get("v"):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+        return response
+
+    # Ensure responses aren't cached
+    if "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers["Expires"] = 0
+        response.headers["Pragma"] = "no-cache"
+    return response
+
+
 def errorhandler(e):
     """Handle error"""
     return apology(e.name, e.code)
@@ -489,4 +936,53 @@ def errorhandler(e):
 
 # listen for errors
 for code in default_exceptions:
-    app.errorhandler(code)(errorhandler)
+    bp.app_errorhandler(code)(errorhandler)
+
+
+@bp.app_errorhandler(CredentialsBusy)
+def credentials_busy(e):
+    """Too many passwords are being hashed, ask the client to come back in a moment"""
+    response, code = apology(str(e), 503)
+    return response, code, {"Retry-After": "1"}
+
+
+def create_app(config=None):
+    """
+    Create the app, configured from the environment and then from the config dict.
+
+    Keys besides Flask's own are DATABASE, SESSION_STORE, BAR_STORE, AUTO_MIGRATE (migrate
+    on the first request, instead of with flask migrate), ORDER_ENGINE, QUOTE_REFRESH and
+    LIVE_PRICES. Nothing is opened or started until the first request, see Services.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(
+
+        # Ensure templates are auto-reloaded
+        TEMPLATES_AUTO_RELOAD=True,
+
+        DATABASE=DATABASE,
+        SESSION_STORE=SESSION_STORE,
+        BAR_STORE=BAR_STORE,
+        AUTO_MIGRATE=os.environ.get("AUTO_MIGRATE", "1") != "0",
+        ORDER_ENGINE=True,
+
+        # Keep the quotes of every held symbol warm in the background, if asked to
+        QUOTE_REFRESH=bool(os.environ.get("QUOTE_REFRESH")),
+
+        # Every open page holds a connection, so the portfolio only subscribes
+        # to live prices if the server has threads or greenlets to spare
+        LIVE_PRICES=bool(os.environ.get("LIVE_PRICES")))
+    app.config.update(config or {})
+    app.extensions["finance"] = Services(app.config)
+
+    # Custom filter
+    app.jinja_env.filters["usd"] = usd
+
+    # Time the requests and serve /metrics, if asked to with METRICS (or profile some, with PROFILE_RATE)
+    metrics.install(app)
+
+    # Keep sessions in a SQLite file shared by every worker (instead of signed cookies), see sessions.py
+    app.session_interface = SqliteSessionInterface(SessionStore(app.config["SESSION_STORE"]))
+
+    app.register_blueprint(bp)
+    return app
@@ -0,0 +1,123 @@
+import calendar
+import csv
+import os
+import time
+
+from datetime import datetime
+
+from database import Database
+
+
+# SQLite file where price bars are kept, next to the shared quotes by default
+BAR_STORE = os.environ.get("BAR_STORE", "quotes.db")
+
+# Format of the bar timestamps of the provider, and of the times accepted by queries
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Created by every connection if missing. WITHOUT ROWID stores the bars in primary key order,
+# so a range is a contiguous read
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS bars (
+        symbol TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        open REAL NOT NULL,
+        high REAL NOT NULL,
+        low REAL NOT NULL,
+        close REAL NOT NULL,
+        volume INTEGER NOT NULL,
+        PRIMARY KEY(symbol, ts)) WITHOUT ROWID"""
+]
+
+
+def to_ts(value):
+    """Turn a "YYYY-MM-DD[ HH:MM:SS]" string or datetime into the integer timestamp of the store."""
+    if isinstance(value, str):
+        value = datetime.strptime(value, TIME_FORMAT if len(value) > 10 else "%Y-%m-%d")
+
+    # Times are the exchange's wall clock, stored as if they were UTC so they never shift
+    return calendar.timegm(value.timetuple())
+
+
+def from_ts(ts):
+    """Turn a timestamp of the store back into a "YYYY-MM-DD HH:MM:SS" string."""
+    return time.strftime(TIME_FORMAT, time.gmtime(ts))
+
+
+def parse_csv(lines):
+    """Yield (time, open, high, low, close, volume) from a provider's timestamp,open,high,low,close,volume CSV."""
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if not header or header[0] != "timestamp":
+        return
+    for row in reader:
+        if len(row) >= 6:
+            yield row[0], float(row[1]), float(row[2]), float(row[3]), float(row[4]), int(float(row[5]))
+
+
+class BarStore:
+    """
+    OHLCV bars of every symbol in a SQLite table keyed (and clustered) by (symbol, ts).
+
+    Re-ingesting overlapping series is harmless: a bar that is already stored is
+    replaced by the new version, which matters for the latest, still open, bar.
+    """
+
+    def __init__(self, path=BAR_STORE):
+        self.path = path
+        self.db = Database(path, schema=SCHEMA)
+
+    def ingest(self, symbol, bars):
+        """Store (time, open, high, low, close, volume) bars of symbol in one transaction, returning how many."""
+        symbol = symbol.upper()
+        rows = [{"symbol": symbol, "ts": to_ts(t), "open": o, "high": h, "low": l, "close": c, "volume": v}
+                for t, o, h, l, c, v in bars]
+        with self.db.transaction():
+            self.db.executemany("""INSERT INTO bars (symbol, ts, open, high, low, close, volume)
+                VALUES (:symbol, :ts, :open, :high, :low, :close, :volume)
+                ON CONFLICT(symbol, ts) DO UPDATE SET
+                    open=excluded.open, high=excluded.high, low=excluded.low,
+                    close=excluded.close, volume=excluded.volume""", rows)
+        return len(rows)
+
+    def ingest_csv(self, symbol, lines):
+        """Store the bars of a provider's CSV (an iterable of lines), returning how many."""
+        return self.ingest(symbol, parse_csv(lines))
+
+    def range(self, symbol, start=None, end=None):
+        """Return the bars of symbol between start and end (inclusive), oldest first, as dicts."""
+        first, last = self._window(start, end)
+        rows = self.db.execute("""SELECT ts, open, high, low, close, volume FROM bars
+            WHERE symbol=:symbol AND ts BETWEEN :first AND :last ORDER BY ts""", symbol=symbol.upper(), first=first, last=last)
+        for row in rows:
+            row["time"] = from_ts(row.pop("ts"))
+        return rows
+
+    def daily_closes(self, symbol, start=None, end=None):
+        """Return a dict mapping "YYYY-MM-DD" days to the last close of symbol on that day."""
+
+        # SQLite returns the close of the row with the MAX(ts) of every group
+        first, last = self._window(start, end)
+        rows = self.db.execute("""SELECT MAX(ts) AS ts, close FROM bars WHERE symbol=:symbol AND ts BETWEEN :first AND :last
+            GROUP BY ts / 86400""", symbol=symbol.upper(), first=first, last=last)
+        return {from_ts(row["ts"])[:10]: row["close"] for row in rows}
+
+    def latest(self, symbol, at=None):
+        """Return the last bar of symbol at or before the time at, or None."""
+        rows = self.db.execute("""SELECT ts, open, high, low, close, volume FROM bars WHERE symbol=:symbol AND ts <= :last
+            ORDER BY ts DESC LIMIT 1""", symbol=symbol.upper(), last=self._window(None, at)[1])
+        if not rows:
+            return None
+        row = rows[0]
+        row["time"] = from_ts(row.pop("ts"))
+        return row
+
+    def _window(self, start, end):
+        """Turn optional start and end times into timestamps, open ends covering everything."""
+        first = to_ts(start) if start else 0
+        last = to_ts(end) if end else 2 ** 62
+
+        # A day given as the end includes the whole day
+        if isinstance(end, str) and len(end) == 10:
+            last += 24 * 60 * 60 - 1
+        return first, last
+
@@ -0,0 +1,89 @@
+"""
+Time analytics.load and analytics.analyze against a per-row Python loop, for one user with many transactions.
+
+    python -m benchmarks.bench_analytics --sizes 100000 1000000
+
+The per-symbol results of analyze are checked against portfolio.replay, the exit
+status is 1 if any of them differ.
+"""
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+
+import analytics
+
+from database import Database
+from migrations import migrate
+from portfolio import replay
+from benchmarks.seed import seed
+
+
+def loop(rows):
+    """The dict-per-row style of index(): replay the trades and value the holdings day by day."""
+    summary = replay((1, row["symbol"], row["shares"], row["price"], row["time"]) for row in rows)
+    held, marks, curve = {}, {}, {}
+    for row in rows:
+        held[row["symbol"]] = held.get(row["symbol"], 0) + row["shares"]
+        marks[row["symbol"]] = row["price"]
+        curve[row["time"][:10]] = sum(held[symbol] * marks[symbol] for symbol in held)
+    return summary, curve
+
+
+def differences(symbols, summary):
+    """Return a line for every value of analyze's symbols that doesn't match replay's summary."""
+    lines = []
+    for (_, symbol), row in summary.items():
+        got = symbols[symbol]
+        if got["shares"] != row["shares"]:
+            lines.append(f"{symbol} shares: {got['shares']} != {row['shares']}")
+
+        # Without shares analyze has no average cost, replay keeps the last one
+        if got["shares"] > 0 and not math.isclose(got["avg_cost"], row["avg_cost"], rel_tol=1e-9):
+            lines.append(f"{symbol} avg_cost: {got['avg_cost']} != {row['avg_cost']}")
+
+        # analyze rounds realized P&L to cents
+        if not math.isclose(got["realized"], row["realized"], rel_tol=1e-9, abs_tol=0.01):
+            lines.append(f"{symbol} realized: {got['realized']} != {row['realized']}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    args = parser.parse_args()
+
+    print(f"{'transactions':>12}{'load s':>10}{'analyze s':>11}{'loop s':>10}{'speedup':>9}{'wrong':>7}")
+    wrong = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "finance.db")
+            migrate(path)
+            seed(path, users=1, transactions=size)
+            db = Database(path)
+
+            started = time.perf_counter()
+            trades = analytics.load(db, 1)
+            loaded = time.perf_counter()
+            result = analytics.analyze(trades)
+            analyzed = time.perf_counter()
+
+            looped = time.perf_counter()
+            summary, _ = loop(db.execute("SELECT symbol, shares, price, time FROM transactions WHERE id_user=1 ORDER BY time, id_tran"))
+            finished = time.perf_counter()
+
+        vectorized, python = analyzed - started, finished - looped
+        lines = differences(result["symbols"], summary)
+        wrong.extend(f"{size} {line}" for line in lines)
+        print(f"{size:>12}{loaded - started:>10.3f}{analyzed - loaded:>11.3f}{python:>10.3f}{python / vectorized:>8.1f}x{len(lines):>7}")
+
+    for line in wrong:
+        print(f"MISMATCH {line}")
+    if wrong:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
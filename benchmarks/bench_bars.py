@@ -0,0 +1,69 @@
+"""
+Time bulk ingestion into bars.BarStore and its range queries, with many symbols of minute bars.
+
+    python -m benchmarks.bench_bars --symbols 50 --days 30
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+from bars import BarStore, TIME_FORMAT
+from benchmarks.seed import SYMBOLS
+
+
+def series(rng, days):
+    """Make up minute bars for the given number of days, oldest first."""
+    start = datetime(2020, 1, 1)
+    price = rng.uniform(10, 500)
+    for minute in range(days * 24 * 60):
+        close = max(0.01, price * (1 + rng.gauss(0, 0.001)))
+        yield ((start + timedelta(minutes=minute)).strftime(TIME_FORMAT),
+               price, max(price, close), min(price, close), close, rng.randrange(100, 10000))
+        price = close
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--symbols", type=int, default=50)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    symbols = (SYMBOLS * (args.symbols // len(SYMBOLS) + 1))[:args.symbols]
+    symbols = [f"{symbol}{i}" for i, symbol in enumerate(symbols)]
+    with tempfile.TemporaryDirectory() as directory:
+        store = BarStore(os.path.join(directory, "quotes.db"))
+
+        # The first series goes in twice, the second time is all overlapping bars
+        data = {symbol: list(series(rng, args.days)) for symbol in symbols}
+        started = time.perf_counter()
+        count = sum(store.ingest(symbol, bars) for symbol, bars in data.items())
+        ingested = time.perf_counter()
+        store.ingest(symbols[0], data[symbols[0]])
+        reingested = time.perf_counter()
+
+        # Random one day windows
+        windows = [(rng.choice(symbols), (datetime(2020, 1, 1) + timedelta(days=rng.randrange(args.days))).strftime("%Y-%m-%d"))
+                   for _ in range(args.queries)]
+        queried = time.perf_counter()
+        returned = sum(len(store.range(symbol, day, day)) for symbol, day in windows)
+        ranged = time.perf_counter()
+        for symbol in symbols:
+            store.daily_closes(symbol)
+        closed = time.perf_counter()
+        stored = store.db.execute("SELECT COUNT(*) AS count FROM bars")[0]["count"]
+
+    print(f"ingested {count} bars in {ingested - started:.2f} s ({count / (ingested - started):,.0f} bars/s)")
+    print(f"re-ingested {count // len(symbols)} overlapping bars in {reingested - ingested:.2f} s, {stored} bars stored")
+    print(f"{args.queries} one day ranges ({returned} bars) in {ranged - queried:.3f} s"
+          f" ({(ranged - queried) / args.queries * 1000:.2f} ms each)")
+    print(f"daily closes of {len(symbols)} symbols in {closed - ranged:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Time a CPU-bound page while passwords are hashed in the request threads, and while they are hashed by credentials.Credentials.
+
+    python -m benchmarks.bench_credentials --hashes 40 --threads 4
+"""
+import argparse
+import threading
+import time
+
+from credentials import Credentials
+
+
+def page():
+    """Stand-in for rendering a portfolio page: a few milliseconds of pure Python."""
+    return sum(i * i for i in range(20000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--hashes", type=int, default=40)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    for _ in range(50):
+        page()
+    alone = (time.perf_counter() - started) / 50
+
+    print(f"{'hashing':>10}{'hashes/s':>10}{'page ms':>9}{'alone ms':>10}")
+    for name, credentials in (("inline", Credentials(workers=0, queue=args.hashes)),
+                              ("pool", Credentials(workers=args.workers, queue=args.hashes))):
+        stored = credentials.hash("password")
+
+        # Some threads log users in, while this one keeps rendering pages
+        remaining = [args.hashes]
+        lock = threading.Lock()
+
+        def login():
+            while True:
+                with lock:
+                    if not remaining[0]:
+                        return
+                    remaining[0] -= 1
+                credentials.check(stored, "password")
+
+        threads = [threading.Thread(target=login) for _ in range(args.threads)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        pages = []
+        while any(thread.is_alive() for thread in threads):
+            rendering = time.perf_counter()
+            page()
+            pages.append(time.perf_counter() - rendering)
+        elapsed = time.perf_counter() - started
+        credentials.shutdown()
+
+        print(f"{name:>10}{args.hashes / elapsed:>10.1f}{sum(pages) / len(pages) * 1000:>9.2f}{alone * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Compare concurrent read/write throughput of the default SQLite settings and the tuned Database.
+
+    python -m benchmarks.bench_database --readers 8 --writers 2 --seconds 5
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from database import Database
+from migrations import migrate
+from trades import TradeError, execute_order
+from benchmarks.seed import SYMBOLS, seed
+
+
+# Settings the CS50 library ran with: rollback journal, full syncs, small page cache, no mmap
+DEFAULTS = {"journal_mode": "DELETE", "synchronous": "FULL", "mmap_size": 0, "cache_size": -2000, "busy_timeout": 5000}
+
+
+def run(db, users, readers, writers, seconds):
+    """Read portfolios and place orders from several threads for a while, returning the counters."""
+    counts = {"reads": 0, "writes": 0, "locked": 0}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def count(name):
+        with lock:
+            counts[name] += 1
+
+    def read(n):
+        rand = random.Random(n)
+        while not stop.is_set():
+            u_id = rand.randint(1, users)
+            try:
+                db.execute("SELECT symbol, amount FROM stocks WHERE id_user=:u_id", u_id=u_id)
+                db.execute("SELECT cash FROM users WHERE id=:u_id", u_id=u_id)
+                count("reads")
+            except sqlite3.OperationalError:
+                count("locked")
+
+    def write(n):
+        rand = random.Random(-n)
+        while not stop.is_set():
+            try:
+                execute_order(db, rand.randint(1, users), rand.choice(SYMBOLS), rand.choice([1, -1]), 1.0)
+                count("writes")
+            except TradeError:
+                pass
+            except sqlite3.OperationalError:
+                count("locked")
+
+    threads = [threading.Thread(target=read, args=(n,)) for n in range(readers)]
+    threads += [threading.Thread(target=write, args=(n,)) for n in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=50, help="per user")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    print(f"{'settings':<10}{'reads/sec':>12}{'writes/sec':>12}{'locked':>8}")
+    for name, settings in [("default", DEFAULTS), ("tuned", {})]:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "finance.db")
+            migrate(path)
+            seed(path, args.users, args.transactions)
+            counts = run(Database(path, **settings), args.users, args.readers, args.writers, args.seconds)
+            print(f"{name:<10}{counts['reads'] / args.seconds:>12.0f}{counts['writes'] / args.seconds:>12.0f}{counts['locked']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Time leaderboard.compute against running index()'s queries for every user, with many users.
+
+    python -m benchmarks.bench_leaderboard --users 1000 10000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+# The quotes are made up, helpers needs no API key
+os.environ.setdefault("QUOTE_PROVIDER", "randomwalk")
+
+import helpers
+import leaderboard
+
+from database import Database
+from migrations import migrate
+from providers import RandomWalkProvider
+from benchmarks.seed import seed
+
+
+def naive(db):
+    """Total every user the way index() does, one user after the other."""
+    totals = []
+    for user in db.execute("SELECT id, cash FROM users"):
+        rows = db.execute("""SELECT symbol, amount, avg_cost FROM stocks LEFT JOIN portfolio USING (id_user, symbol)
+            WHERE id_user=:u_id""", u_id=user["id"])
+        quotes = helpers.lookup_many(row["symbol"] for row in rows)
+        totals.append(user["cash"] + sum(row["amount"] * quotes[row["symbol"]]["price"] for row in rows))
+    return sorted(totals, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds every quote takes")
+    args = parser.parse_args()
+
+    # Quotes come from the fake provider, and only from memory once fetched
+    helpers.quote_store = None
+    helpers.set_provider(RandomWalkProvider(latency=args.latency, seed=1))
+
+    print(f"{'users':>8}{'compute s':>11}{'cached s':>10}{'naive s':>9}{'speedup':>9}")
+    for users in args.users:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "finance.db")
+            migrate(path)
+            seed(path, users=users, transactions=20)
+            db = Database(path)
+
+            helpers.quote_cache.clear()
+            board = leaderboard.Leaderboard(db)
+            started = time.perf_counter()
+            board.get()
+            computed = time.perf_counter()
+            board.get()
+            cached = time.perf_counter() - computed
+
+            helpers.quote_cache.clear()
+            looped = time.perf_counter()
+            naive(db)
+            finished = time.perf_counter()
+
+        fast, slow = computed - started, finished - looped
+        print(f"{users:>8}{fast:>11.3f}{cached:>10.6f}{slow:>9.3f}{slow / fast:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Time the limit/stop order engine with many open orders: finding the triggered ones, and filling them.
+
+    python -m benchmarks.bench_orders --orders 100000 --ticks 1000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+# The quotes are made up, helpers needs no API key
+os.environ.setdefault("QUOTE_PROVIDER", "randomwalk")
+
+import orders
+
+from database import Database
+from migrations import migrate
+from benchmarks.seed import SYMBOLS, seed
+
+
+def scan(db, symbol, price):
+    """Find the triggered orders with a query over the open orders of the symbol, instead of the heaps."""
+    return db.execute("""SELECT * FROM orders WHERE symbol=:symbol AND status='open' AND (
+        ((shares > 0) = (kind = 'limit') AND trigger >= :price) OR
+        ((shares > 0) != (kind = 'limit') AND trigger <= :price))""", symbol=symbol, price=price)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--ticks", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "finance.db")
+        migrate(path)
+        seed(path, users=args.users, transactions=20)
+        db = Database(path)
+
+        # Resting orders on the side of the price of 100 they are waiting for, so few trigger at once
+        rows = []
+        for _ in range(args.orders):
+            shares, kind = rng.choice([-1, 1]) * rng.randint(1, 5), rng.choice(orders.KINDS)
+            trigger = rng.uniform(50, 100) if orders.falls(shares, kind) else rng.uniform(100, 150)
+            rows.append((rng.randint(1, args.users), rng.choice(SYMBOLS), shares, kind, round(trigger, 2), "2020-01-01 00:00:00"))
+        with db.transaction():
+            db.connection().executemany("""INSERT INTO orders (id_user, symbol, shares, kind, trigger, created)
+                VALUES (?, ?, ?, ?, ?, ?)""", rows)
+
+        engine = orders.OrderEngine(db)
+        started = time.perf_counter()
+        engine.sync()
+        loaded = time.perf_counter() - started
+
+        # Prices moving slowly around 100, every tick triggers the orders it crosses
+        ticks, prices = [], dict.fromkeys(SYMBOLS, 100.0)
+        for _ in range(args.ticks):
+            symbol = rng.choice(SYMBOLS)
+            prices[symbol] *= 1 + rng.gauss(0, 0.01)
+            ticks.append((symbol, prices[symbol]))
+
+        started = time.perf_counter()
+        for symbol, price in ticks[:200]:
+            scan(db, symbol, price)
+        scanned = (time.perf_counter() - started) / 200
+
+        started = time.perf_counter()
+        triggered = [(order, price) for symbol, price in ticks for order in engine.book.triggered(symbol, price)]
+        heaped = (time.perf_counter() - started) / len(ticks)
+
+        # Fill what triggered, in batches and then one transaction per order
+        half = len(triggered) // 2
+        started = time.perf_counter()
+        for i in range(0, half, engine.batch):
+            engine.execute(triggered[i:min(i + engine.batch, half)])
+        batched = (time.perf_counter() - started) / max(half, 1)
+        started = time.perf_counter()
+        for fill in triggered[half:]:
+            engine.execute([fill])
+        single = (time.perf_counter() - started) / max(len(triggered) - half, 1)
+
+    print(f"{args.orders} open orders loaded in {loaded:.2f} s")
+    print(f"{len(ticks)} ticks triggered {len(triggered)} orders: {heaped * 1e6:.1f} us per tick with the heaps,"
+          f" {scanned * 1e6:.0f} us per tick scanning the open orders")
+    print(f"fills: {batched * 1e6:.0f} us each in batches of {engine.batch}, {single * 1e6:.0f} us each alone"
+          f" ({engine.filled} filled, {engine.rejected} rejected)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Time the hot per-user queries before and after the index migration.
+
+    python -m benchmarks.bench_schema --users 2000 --transactions 200
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from migrations import migrate
+from benchmarks.seed import SYMBOLS, seed
+
+
+# The queries behind index, sell, buy, history and login, with a function making their parameters
+QUERIES = {
+    "portfolio": ("SELECT symbol, amount FROM stocks WHERE id_user=?",
+                  lambda rand, users: (rand.randint(1, users),)),
+    "holding": ("SELECT amount FROM stocks WHERE id_user=? AND symbol=?",
+                lambda rand, users: (rand.randint(1, users), rand.choice(SYMBOLS))),
+    "history": ("SELECT symbol, shares, price, time FROM transactions WHERE id_user=?",
+                lambda rand, users: (rand.randint(1, users),)),
+    "login": ("SELECT * FROM users WHERE username=?",
+              lambda rand, users: (f"user{rand.randint(0, users - 1)}",))
+}
+
+
+def measure(path, users, repeat):
+    """Return the mean milliseconds of every query, over repeat random users."""
+    connection = sqlite3.connect(path)
+    results = {}
+    for name, (query, params) in QUERIES.items():
+        rand = random.Random(name)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            connection.execute(query, params(rand, users)).fetchall()
+        results[name] = (time.perf_counter() - started) * 1000 / repeat
+    connection.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=100, help="per user")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "finance.db")
+
+        # Seed the original schema, without indexes
+        migrate(path, target=1)
+        seed(path, args.users, args.transactions)
+        before = measure(path, args.users, args.repeat)
+
+        migrate(path)
+        after = measure(path, args.users, args.repeat)
+
+    print(f"{args.users} users, {args.users * args.transactions} transactions")
+    print(f"{'query':<12}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for name in QUERIES:
+        print(f"{name:<12}{before[name]:>12.3f}{after[name]:>12.3f}{before[name] / after[name]:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Time the per-request cost of the session backends, for requests that only read the session and ones that change it.
+
+    python -m benchmarks.bench_sessions --requests 5000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from flask import Flask, session
+
+from sessions import SessionStore, SqliteSessionInterface
+
+
+def make_app(backend, directory):
+    """Return an app with a reading and a writing route, keeping its sessions in backend."""
+    app = Flask(__name__)
+    app.secret_key = "benchmark"
+    if backend == "sqlite":
+        app.session_interface = SqliteSessionInterface(SessionStore(os.path.join(directory, "sessions.db")))
+    elif backend == "filesystem":
+        from flask_session import Session
+        app.config["SESSION_FILE_DIR"] = os.path.join(directory, "sessions")
+        app.config["SESSION_PERMANENT"] = False
+        app.config["SESSION_TYPE"] = "filesystem"
+        Session(app)
+
+    @app.route("/login")
+    def login():
+        session["user_id"] = 1
+        return ""
+
+    @app.route("/read")
+    def read():
+        return str(session.get("user_id"))
+
+    @app.route("/write")
+    def write():
+        session["visits"] = session.get("visits", 0) + 1
+        return ""
+
+    @app.route("/none")
+    def none():
+        return ""
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    # Flask-Session is no longer a dependency, it is only compared against if it is installed
+    backends = ["cookie", "sqlite"]
+    try:
+        import flask_session  # noqa: F401
+        backends.append("filesystem")
+    except ImportError:
+        pass
+
+    print(f"{'backend':>12}{'no session us':>15}{'read us':>10}{'write us':>10}")
+    for backend in backends:
+        with tempfile.TemporaryDirectory() as directory:
+            client = make_app(backend, directory).test_client()
+            client.get("/login")
+            timings = []
+            for route in ("/none", "/read", "/write"):
+                started = time.perf_counter()
+                for _ in range(args.requests):
+                    client.get(route)
+                timings.append((time.perf_counter() - started) / args.requests * 1e6)
+        print(f"{backend:>12}{timings[0]:>15.0f}{timings[1]:>10.0f}{timings[2]:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Time the fan-out of stream.PriceStream, with many clients subscribed to a few symbols.
+
+    python -m benchmarks.bench_stream --clients 100 1000 10000
+"""
+import argparse
+import os
+import random
+import time
+
+# The quotes are made up, helpers needs no API key
+os.environ.setdefault("QUOTE_PROVIDER", "randomwalk")
+
+import helpers
+
+from providers import RandomWalkProvider
+from stream import PriceStream
+from benchmarks.seed import SYMBOLS
+
+
+class CountingProvider(RandomWalkProvider):
+    """Random walk provider that counts the quotes asked upstream."""
+
+    calls = 0
+
+    def quote(self, symbol, timeout=None):
+        CountingProvider.calls += 1
+        return super().quote(symbol, timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--polls", type=int, default=20)
+    args = parser.parse_args()
+
+    helpers.quote_store = None
+    helpers.set_provider(CountingProvider(seed=1))
+    rng = random.Random(0)
+
+    print(f"{'clients':>8}{'symbols':>9}{'quotes/poll':>13}{'events/poll':>13}{'poll ms':>9}{'drops':>7}")
+    for clients in args.clients:
+        stream = PriceStream(poller=False)
+        subscriptions = [stream.subscribe(rng.sample(SYMBOLS, 5)) for _ in range(clients)]
+
+        # Every poll asks again, as it would once the quote cache expired. The clients read everything in between
+        CountingProvider.calls, elapsed, events = 0, 0.0, 0
+        for _ in range(args.polls):
+            helpers.quote_cache.clear()
+            started = time.perf_counter()
+            stream.poll()
+            elapsed += time.perf_counter() - started
+            for subscription in subscriptions:
+                while not subscription.events.empty():
+                    subscription.events.get_nowait()
+                    events += 1
+        for subscription in subscriptions:
+            stream.unsubscribe(subscription)
+
+        print(f"{clients:>8}{len(SYMBOLS):>9}{CountingProvider.calls / args.polls:>13.1f}"
+              f"{events / args.polls:>13.0f}{elapsed / args.polls * 1000:>9.2f}{stream.drops:>7}")
+
+
+if __name__ == "__main__":
+    main()
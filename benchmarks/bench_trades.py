@@ -0,0 +1,113 @@
+"""
+Compare orders/sec of the old autocommitted trade path and trades.execute_order.
+
+    python -m benchmarks.bench_trades --orders 2000 --threads 4
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from datetime import datetime
+
+import trades
+
+from database import Database
+from migrations import migrate
+from benchmarks.seed import SYMBOLS, seed
+
+
+def autocommit_order(path, u_id, symbol, shares, price):
+    """The statements buy() and sell() used to run, each one committed on its own."""
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    t = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cash = db.execute("SELECT cash FROM users WHERE id=?", (u_id,)).fetchone()[0]
+    if shares > 0:
+        if cash < price * shares:
+            return
+        db.execute("UPDATE users SET cash=? WHERE id=?", (cash - price * shares, u_id))
+        db.execute("INSERT INTO transactions (id_user, symbol, shares, price, time) VALUES (?, ?, ?, ?, ?)",
+                   (u_id, symbol, shares, price, t))
+        stock = db.execute("SELECT id_stock FROM stocks WHERE id_user=? AND symbol=?", (u_id, symbol)).fetchone()
+        if not stock:
+            db.execute("INSERT INTO stocks (id_user, symbol, amount) VALUES (?, ?, ?)", (u_id, symbol, shares))
+        else:
+            amount = db.execute("SELECT amount FROM stocks WHERE id_stock=?", stock).fetchone()[0]
+            db.execute("UPDATE stocks SET amount=? WHERE id_stock=?", (amount + shares, stock[0]))
+    else:
+        available = db.execute("SELECT amount FROM stocks WHERE id_user=? AND symbol=?", (u_id, symbol)).fetchone()
+        if not available or available[0] < -shares:
+            return
+        db.execute("INSERT INTO transactions (id_user, symbol, shares, price, time) VALUES (?, ?, ?, ?, ?)",
+                   (u_id, symbol, shares, price, t))
+        db.execute("UPDATE users SET cash=? WHERE id=?", (cash - shares * price, u_id))
+        if available[0] == -shares:
+            db.execute("DELETE FROM stocks WHERE id_user=? AND symbol=?", (u_id, symbol))
+        else:
+            db.execute("UPDATE stocks SET amount=? WHERE id_user=? AND symbol=?", (available[0] + shares, u_id, symbol))
+    db.close()
+
+
+# One Database per file, so every thread keeps reusing its connection
+databases = {}
+
+
+def single_transaction_order(path, u_id, symbol, shares, price):
+    """The new path, ignoring orders that can't be executed like the old one does."""
+    try:
+        trades.execute_order(databases.setdefault(path, Database(path)), u_id, symbol, shares, price)
+    except trades.TradeError:
+        pass
+
+
+def consistent(path):
+    """Tell whether every user's cash and stocks still match their transactions."""
+    db = sqlite3.connect(path)
+    bad = db.execute("""SELECT COUNT(*) FROM users WHERE ABS(cash - (10000 -
+        (SELECT COALESCE(SUM(shares * price), 0) FROM transactions WHERE id_user=users.id))) > 0.01""").fetchone()[0]
+    bad += db.execute("""SELECT COUNT(*) FROM (SELECT id_user, symbol, SUM(shares) AS held FROM transactions
+        GROUP BY id_user, symbol) AS t LEFT JOIN stocks AS s USING (id_user, symbol)
+        WHERE t.held != COALESCE(s.amount, 0)""").fetchone()[0]
+    db.close()
+    return not bad
+
+
+def run(order, path, orders, threads, users):
+    """Send orders from threads at once, all of them hitting the same few users, returning orders/sec."""
+    def worker(n):
+        rand = random.Random(n)
+        for _ in range(orders // threads):
+            shares = rand.randint(1, 5) * rand.choice([1, 1, -1])
+            order(path, rand.randint(1, users), rand.choice(SYMBOLS[:3]), shares, 1.0)
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return orders / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--users", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'path':<20}{'orders/sec':>12}  consistent")
+    for name, order in [("autocommit", autocommit_order), ("single transaction", single_transaction_order)]:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "finance.db")
+            migrate(path)
+            seed(path, args.users, 0)
+            rate = run(order, path, args.orders, args.threads, args.users)
+            print(f"{name:<20}{rate:>12.0f}  {consistent(path)}")
+
+
+if __name__ == "__main__":
+    main()
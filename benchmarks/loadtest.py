@@ -0,0 +1,285 @@
+"""
+Load test the main routes, through the Flask test client and through a real multi-worker server.
+
+    python -m benchmarks.loadtest --users 1000 --transactions 100 --requests 500 --output results.json
+    python -m benchmarks.loadtest --mode server --workers 4 --baseline results.json
+
+Every run seeds a fresh database, with made up quotes that take --latency seconds,
+so results of the same arguments on the same machine can be compared. The results
+(throughput and p50/p95/p99 latency per route) are printed and written as JSON.
+Against a --baseline, routes whose p95 or throughput got worse by more than
+--tolerance are listed and the exit status is 1.
+"""
+import argparse
+import http.cookiejar
+import importlib.util
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.seed import seed
+
+
+# Routes driven, in order. buy and sell trade the same symbol, so every sell has a share to sell
+ROUTES = ["login", "index", "buy", "sell", "history"]
+SYMBOL = "AAPL"
+PASSWORD = "Passw0rd!"
+
+
+def environment(directory, args):
+    """Return the environment the app runs with: files in directory, fake quotes, cheap hashing."""
+    return dict(os.environ,
+                DATABASE=os.path.join(directory, "finance.db"),
+                QUOTE_STORE=os.path.join(directory, "quotes.db"),
+                BAR_STORE=os.path.join(directory, "quotes.db"),
+                SESSION_STORE=os.path.join(directory, "sessions.db"),
+                QUOTE_PROVIDER="randomwalk",
+                QUOTE_LATENCY=str(args.latency),
+                QUOTE_SEED="0",
+                HASH_METHOD=args.hash_method)
+
+
+def request(route, user):
+    """Return the (method, path, form) of a request to route, as user."""
+    if route == "login":
+        return "POST", "/login", {"username": f"user{user}", "password": PASSWORD}
+    if route == "index":
+        return "GET", "/", None
+    if route == "buy":
+        return "POST", "/buy", {"symbol": SYMBOL, "shares": "1"}
+    if route == "sell":
+        return "POST", "/sell", {"symbol": SYMBOL, "shares": "1"}
+    return "GET", "/history", None
+
+
+class ClientSession:
+    """A logged in user of the Flask test client."""
+
+    def __init__(self, app, user):
+        self.client = app.test_client()
+        self.user = user
+        self.send("login")
+
+    def send(self, route):
+        """Send a request to route, returning its status code."""
+        method, path, form = request(route, self.user)
+        return self.client.open(path, method=method, data=form).status_code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Return redirects as they are, like the test client does."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class ServerSession:
+    """A logged in user of the server at base, with its own cookies."""
+
+    def __init__(self, base, user):
+        self.base = base
+        self.user = user
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+        self.send("login")
+
+    def send(self, route):
+        """Send a request to route, returning its status code."""
+        method, path, form = request(route, self.user)
+        data = urllib.parse.urlencode(form).encode() if form else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base + path, data=data, method=method), timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+def percentile(values, p):
+    """Return the nearest-rank percentile p (0-100) of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def drive(sessions, route, requests):
+    """Send requests to route, split between the sessions (one thread each). Returns the route's stats."""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def worker(session, count):
+        mine, failed = [], 0
+        for _ in range(count):
+            started = time.perf_counter()
+            status = session.send(route)
+            mine.append(time.perf_counter() - started)
+            failed += status >= 400
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    share, extra = divmod(requests, len(sessions))
+    threads = [threading.Thread(target=worker, args=(session, share + (i < extra)))
+               for i, session in enumerate(sessions)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000
+    }
+
+
+def prepare(directory, args):
+    """Point this process at directory and seed a database there."""
+
+    # The app's modules read their settings when imported, so they are imported after this
+    os.environ.update(environment(directory, args))
+    from database import DATABASE
+    from migrations import migrate
+
+    migrate(DATABASE)
+    seed(DATABASE, users=max(args.users, args.concurrency), transactions=args.transactions,
+         hash=generate_password_hash(PASSWORD, args.hash_method))
+
+
+def run_client(args):
+    """Drive the routes through the Flask test client, in this process."""
+    from app import create_app
+    app = create_app()
+    sessions = [ClientSession(app, user) for user in range(args.concurrency)]
+    return {route: drive(sessions, route, args.requests) for route in args.routes}
+
+
+def free_port():
+    """Return a TCP port nobody listens on."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_server(directory, args):
+    """Drive the routes through a real server: gunicorn with --workers if installed, else werkzeug's threaded one."""
+    port = free_port()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if importlib.util.find_spec("gunicorn"):
+        command = [sys.executable, "-m", "gunicorn", "--workers", str(args.workers), "--threads", str(args.threads),
+                   "--bind", f"127.0.0.1:{port}", "--chdir", root, "app:create_app()"]
+        server = f"gunicorn, {args.workers} workers x {args.threads} threads"
+    else:
+        command = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port), "--with-threads"]
+        server = "werkzeug, 1 process (gunicorn isn't installed)"
+    process = subprocess.Popen(command, cwd=root, env=environment(directory, args),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+
+        # Wait for the server to listen
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError(f"server didn't start: {' '.join(command)}")
+                time.sleep(0.1)
+
+        base = f"http://127.0.0.1:{port}"
+        sessions = [ServerSession(base, user) for user in range(args.concurrency)]
+        results = {route: drive(sessions, route, args.requests) for route in args.routes}
+        results["server"] = server
+        return results
+    finally:
+        process.terminate()
+        process.wait(10)
+
+
+def compare(results, baseline, tolerance):
+    """Return a line for every route of results that did worse than in baseline."""
+    regressions = []
+    for mode, routes in results.items():
+        for route, now in routes.items():
+            before = baseline.get(mode, {}).get(route)
+            if not isinstance(now, dict) or not isinstance(before, dict):
+                continue
+            if now["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{mode} {route}: p95 {before['p95_ms']:.1f} -> {now['p95_ms']:.1f} ms")
+            if now["throughput"] < before["throughput"] * (1 - tolerance):
+                regressions.append(f"{mode} {route}: {before['throughput']:.0f} -> {now['throughput']:.0f} req/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=["client", "server", "both"], default="client")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=100, help="transactions per user")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds every quote takes")
+    parser.add_argument("--requests", type=int, default=500, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=8, help="users sending requests at once")
+    parser.add_argument("--workers", type=int, default=4, help="server worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="threads per server worker")
+    parser.add_argument("--routes", nargs="+", choices=ROUTES, default=ROUTES)
+    parser.add_argument("--hash-method", default="pbkdf2:sha256:1000", help="cheap by default, so login measures the app")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        prepare(directory, args)
+
+        results = {}
+        if args.mode in ("server", "both"):
+            results["server"] = run_server(directory, args)
+        if args.mode in ("client", "both"):
+            results["client"] = run_client(args)
+
+    print(f"{'mode':>8}{'route':>9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for mode, routes in results.items():
+        for route, stats in routes.items():
+            if isinstance(stats, dict):
+                print(f"{mode:>8}{route:>9}{stats['throughput']:>9.1f}{stats['p50_ms']:>9.1f}"
+                      f"{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}{stats['errors']:>8}")
+        if "server" in routes:
+            print(f"{mode:>8}: {routes['server']}")
+
+    if args.output:
+        config = {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}
+        with open(args.output, "w") as f:
+            json.dump({"config": config, "python": platform.python_version(), "machine": platform.machine(),
+                       "cpus": os.cpu_count(), "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regression against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import random
+import sqlite3
+
+from datetime import datetime, timedelta
+
+from portfolio import replay
+
+
+# Symbols the seeded users trade
+SYMBOLS = ["AAPL", "AMZN", "GOOG", "IBM", "INTC", "META", "MSFT", "NFLX", "NVDA", "ORCL",
+           "PEP", "KO", "T", "TSLA", "V", "WMT", "XOM", "CSCO", "DIS", "BA"]
+
+
+def seed(path, users=1000, transactions=100, symbols=SYMBOLS, hash="x", seed=0):
+    """
+    Fill the database at path with users trading symbols, transactions times each.
+
+    Holdings in stocks (and the portfolio, if the schema has it yet) match the
+    transactions. Usernames are user0, user1... and every user gets the same password hash.
+    """
+    rand = random.Random(seed)
+    connection = sqlite3.connect(path)
+    with connection:
+        portfolio = connection.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='portfolio'").fetchone()
+        first = connection.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0] + 1
+        connection.executemany("INSERT INTO users (id, username, hash, cash) VALUES (?, ?, ?, ?)",
+                               [(first + i, f"user{first + i - 1}", hash, 10000.0) for i in range(users)])
+
+        start = datetime(2020, 1, 1)
+        for id_user in range(first, first + users):
+            held, rows = {}, []
+            for n in range(transactions):
+
+                # Sell part of a holding every so often, buy otherwise
+                symbol = rand.choice(symbols)
+                shares = rand.randint(1, 20)
+                if held.get(symbol, 0) >= shares and rand.random() < 0.3:
+                    shares = -shares
+                held[symbol] = held.get(symbol, 0) + shares
+                t = start + timedelta(minutes=n * 37 + rand.randint(0, 30))
+                rows.append((id_user, symbol, shares, round(rand.uniform(10, 500), 2), t.strftime("%Y-%m-%d %H:%M:%S")))
+
+            connection.executemany("INSERT INTO transactions (id_user, symbol, shares, price, time) VALUES (?, ?, ?, ?, ?)", rows)
+            connection.executemany("INSERT INTO stocks (id_user, symbol, amount) VALUES (?, ?, ?)",
+                                   [(id_user, symbol, amount) for symbol, amount in held.items() if amount])
+
+            # The rows are in time order already, as replay() wants them
+            if portfolio:
+                connection.executemany("""INSERT INTO portfolio (id_user, symbol, shares, avg_cost, realized, last_trade)
+                    VALUES (?, ?, ?, ?, ?, ?)""", [(id_user, symbol, row["shares"], row["avg_cost"], row["realized"],
+                                                    row["last_trade"]) for (_, symbol), row in replay(rows).items()])
+    connection.close()
@@ -0,0 +1,136 @@
+"""
+Password hashing and verification, run in a pool of worker processes.
+
+Hashing is deliberately slow, and done in the request threads it holds the GIL
+long enough to stall every other page served by the process. Here it runs in
+HASH_WORKERS processes instead. At most HASH_QUEUE hashes are waiting or running
+at once: past that, CredentialsBusy is raised (and the app answers 503) rather
+than queueing logins without bound. A pool whose worker died is replaced by a
+new one, the requests it broke get CredentialsBusy too.
+
+HASH_METHOD is any method werkzeug understands ("scrypt", "pbkdf2:sha256:600000"...).
+Stored hashes made with other parameters are replaced on the next successful login.
+"""
+import metrics
+import multiprocessing
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# How passwords are hashed, in werkzeug's notation
+HASH_METHOD = os.environ.get("HASH_METHOD", "scrypt")
+
+# Processes hashing passwords (0 hashes in the request thread), and hashes allowed to wait or run at once
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", min(4, os.cpu_count() or 1)))
+HASH_QUEUE = int(os.environ.get("HASH_QUEUE", 4 * max(HASH_WORKERS, 1)))
+
+# Seconds a request waits for room in the queue before giving up
+HASH_WAIT = float(os.environ.get("HASH_WAIT", 0.5))
+
+
+class CredentialsBusy(Exception):
+    """Too many passwords are being hashed already, the request should be retried later."""
+
+
+def _verify(h, password, method):
+    """Check password against h, returning (matches, new hash if h was made with other parameters)."""
+    if not check_password_hash(h, password):
+        return False, None
+    if h.split("$", 1)[0] != _parameters(method):
+        return True, generate_password_hash(password, method)
+    return True, None
+
+
+def _hash(password, method):
+    """Hash password with method."""
+    return generate_password_hash(password, method)
+
+
+# How the hashes of every method start, worked out once per process
+_known = {}
+
+
+def _parameters(method):
+    """Return how hashes made with method start, with werkzeug's defaults filled in ("scrypt:32768:8:1")."""
+    if method not in _known:
+        _known[method] = generate_password_hash("", method).split("$", 1)[0]
+    return _known[method]
+
+
+class Credentials:
+    """Hashes and checks passwords in a process pool, with a bounded queue."""
+
+    def __init__(self, method=HASH_METHOD, workers=HASH_WORKERS, queue=HASH_QUEUE, wait=HASH_WAIT):
+        self.method = method
+        self.workers = workers
+        self.wait = wait
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(queue)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def check(self, h, password):
+        """
+        Return whether password matches the stored hash h, and the hash that should replace
+        h if it was made with outdated parameters (None if it is fine, or didn't match).
+        """
+        return self._run(_verify, h, password, self.method)
+
+    def hash(self, password):
+        """Return the hash of password to store."""
+        return self._run(_hash, password, self.method)
+
+    def stats(self):
+        """Return the pool settings and how many requests it turned away, as a dict."""
+        return {"method": self.method, "workers": self.workers, "rejected": self.rejected}
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        with self._lock:
+            if self._pool:
+                self._pool.shutdown()
+                self._pool = None
+
+    def _run(self, function, *args):
+        """Run function in the pool, waiting for its result. Raises CredentialsBusy if the queue is full."""
+        with metrics.timer("hash"):
+            if not self._slots.acquire(timeout=self.wait):
+                with self._lock:
+                    self.rejected += 1
+                raise CredentialsBusy("too many logins at once, try again")
+            try:
+                if not self.workers:
+                    return function(*args)
+                pool = self._executor()
+                try:
+                    return pool.submit(function, *args).result()
+                except BrokenProcessPool:
+
+                    # A worker died (killed for memory, say): the next request starts a new pool
+                    self._discard(pool)
+                    raise CredentialsBusy("password checks are restarting, try again")
+            finally:
+                self._slots.release()
+
+    def _discard(self, pool):
+        """Forget pool if it is still the current one, so _executor starts another."""
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _executor(self):
+        """Return the pool, starting it the first time."""
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+
+                    # Forking a process with threads running is unsafe, so workers start from a clean process
+                    methods = multiprocessing.get_all_start_methods()
+                    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=context)
+        return self._pool
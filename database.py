@@ -0,0 +1,123 @@
+import metrics
+import os
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+
+
+# SQLite database of the app
+DATABASE = os.environ.get("DATABASE", "finance.db")
+
+# Connection tuning, see https://www.sqlite.org/pragma.html
+DB_JOURNAL_MODE = os.environ.get("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT = int(os.environ.get("DB_BUSY_TIMEOUT", 5000))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 * 1024))
+DB_CACHE_SIZE = int(os.environ.get("DB_CACHE_SIZE", -16000))
+
+# Prepared statements kept by every connection
+DB_STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", 256))
+
+
+def _dict_factory(cursor, row):
+    """Make rows into dicts, like the CS50 library did."""
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class Database:
+    """
+    Thread-safe access to a SQLite database, through one tuned connection per thread.
+
+    execute() has the interface of the CS50 library's SQL.execute: named parameters
+    as keyword arguments, a list of dicts for SELECT, the new id for INSERT and the
+    number of rows changed for UPDATE and DELETE. schema lists the statements every
+    new connection runs first, for stores that create their own tables.
+    """
+
+    def __init__(self, path=DATABASE, journal_mode=DB_JOURNAL_MODE, synchronous=DB_SYNCHRONOUS,
+                 busy_timeout=DB_BUSY_TIMEOUT, mmap_size=DB_MMAP_SIZE, cache_size=DB_CACHE_SIZE,
+                 statements=DB_STATEMENT_CACHE, schema=()):
+        self.path = path
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.statements = statements
+        self.schema = schema
+        self._local = threading.local()
+
+    def connection(self):
+        """Return the connection of the current thread, opening it the first time."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+
+            # Autocommit mode, transactions are started explicitly by transaction()
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000, isolation_level=None,
+                                         cached_statements=self.statements)
+            connection.row_factory = _dict_factory
+
+            # WAL lets readers go on while somebody writes, and only needs to sync at checkpoints
+            connection.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            connection.execute(f"PRAGMA synchronous={self.synchronous}")
+            connection.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+            connection.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+            connection.execute(f"PRAGMA cache_size={int(self.cache_size)}")
+
+            # Stores that keep their own tables create them (IF NOT EXISTS) as they connect
+            for statement in self.schema:
+                connection.execute(statement)
+            self._local.connection = connection
+        return connection
+
+    def execute(self, sql, **params):
+        """Run a single statement, returning rows, the new id or the number of changed rows."""
+        with metrics.timer("db"):
+            cursor = self.connection().execute(sql, params)
+            command = sql.lstrip().split(None, 1)[0].upper()
+            if command in ("SELECT", "WITH", "PRAGMA"):
+                return cursor.fetchall()
+            if command in ("INSERT", "REPLACE"):
+                return cursor.lastrowid
+            if command in ("UPDATE", "DELETE"):
+                return cursor.rowcount
+            return True
+
+    def executemany(self, sql, rows):
+        """Run a statement once per dict of named parameters in rows, returning the number of rows changed."""
+        with metrics.timer("db"):
+            return self.connection().executemany(sql, rows).rowcount
+
+    def iterate(self, sql, **params):
+        """Yield the rows of a query one at a time, without loading them all in memory."""
+        with metrics.timer("db"):
+            cursor = self.connection().execute(sql, params)
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a block in a single write transaction, committed at the end or rolled back on error.
+
+        BEGIN IMMEDIATE takes the write lock up front, so concurrent writers wait for
+        each other instead of reading values that are about to change.
+        """
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def close(self):
+        """Close the connection of the current thread."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
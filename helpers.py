@@ -1,10 +1,42 @@
-import csv
+import metrics
 import os
-import urllib.request
+import random
+import threading
+import time
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from flask import redirect, render_template, request, session
 from functools import wraps
 
+from providers import PoolExhausted, QuoteError, make_provider
+from quotestore import QUOTE_STORE, QuoteStore
+
+
+# Seconds a quote stays fresh. Matches the 1 minute interval we request from the API
+QUOTE_TTL = float(os.environ.get("QUOTE_TTL", 60))
+
+# Maximum number of symbols kept in memory before the least recently used is evicted
+QUOTE_CACHE_SIZE = int(os.environ.get("QUOTE_CACHE_SIZE", 1024))
+
+# Maximum number of quotes fetched at the same time by lookup_many
+QUOTE_WORKERS = int(os.environ.get("QUOTE_WORKERS", 8))
+
+# Seconds lookup_many waits for quotes before giving up on the slow ones
+QUOTE_DEADLINE = float(os.environ.get("QUOTE_DEADLINE", 5))
+
+# How many times a failed fetch is retried, and the overall seconds allowed for all attempts
+QUOTE_RETRIES = int(os.environ.get("QUOTE_RETRIES", 3))
+QUOTE_TIMEOUT = float(os.environ.get("QUOTE_TIMEOUT", 10))
+
+# Base and maximum seconds of the exponential backoff between retries
+QUOTE_BACKOFF = float(os.environ.get("QUOTE_BACKOFF", 0.5))
+QUOTE_BACKOFF_MAX = float(os.environ.get("QUOTE_BACKOFF_MAX", 4))
+
+# Consecutive failures that open the circuit breaker, and seconds it stays open
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 30))
+
 
 def apology(message, code=400):
     """Render message as an apology to user."""
@@ -71,8 +103,165 @@ def login_required(f):
     return decorated_function
 
 
-def lookup(symbol):
-    """Look up quote for symbol."""
+class CircuitBreaker:
+    """Fail fast for a cooldown after too many consecutive errors."""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = self.trips = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Tell whether a request may be sent right now."""
+        with self._lock:
+            if self.state == "closed":
+                return True
+
+            # Once the cooldown is over, let a single request through to probe the API
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half-open"
+                return True
+            return False
+
+    def success(self):
+        """Record a successful request, closing the breaker."""
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def abort(self):
+        """Give back a request allowed but never sent, so the next one can probe the API instead."""
+        with self._lock:
+            if self.state == "half-open":
+                self.state = "open"
+
+    def failure(self):
+        """Record a failed request, opening the breaker if there were too many."""
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    self.trips += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def status(self):
+        """Return the breaker state as a dict."""
+        with self._lock:
+            retry_in = 0
+            if self.state == "open":
+                retry_in = max(self.cooldown - (time.monotonic() - self.opened_at), 0)
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "trips": self.trips,
+                "retry_in": round(retry_in, 3)
+            }
+
+
+class QuoteCache:
+    """Thread-safe LRU cache of quotes that go stale after ttl seconds."""
+
+    def __init__(self, ttl=QUOTE_TTL, maxsize=QUOTE_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = self.misses = self.stale = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, symbol, count=True):
+        """Return the cached quote for symbol, or None if it is missing or stale."""
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry is None:
+                self.misses += count
+                return None
+
+            # Drop quotes older than the freshness window, so the caller fetches a new one
+            fetched_at, quote = entry
+            if time.monotonic() - fetched_at > self.ttl:
+                del self._entries[symbol]
+                self.stale += count
+                return None
+
+            # Mark the symbol as the most recently used
+            self._entries.move_to_end(symbol)
+            self.hits += count
+            return quote
+
+    def put(self, symbol, quote, age=0):
+        """Store a quote fetched age seconds ago, evicting the least recently used ones if full."""
+        with self._lock:
+            self._entries[symbol] = (time.monotonic() - age, quote)
+            self._entries.move_to_end(symbol)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Forget every cached quote."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the cache counters as a dict."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions
+            }
+
+
+# Quotes are shared by every request (and user) served by this process
+quote_cache = QuoteCache()
+
+# Symbols the provider answered don't exist, as opposed to the ones it failed to price, see unknown()
+unknown_symbols = QuoteCache()
+
+# Where quotes come from, chosen with QUOTE_PROVIDER. Built by the first fetch, see provider()
+quote_provider = None
+_provider_lock = threading.Lock()
+
+# Quotes shared with the other worker processes, if enabled with QUOTE_STORE
+quote_store = QuoteStore() if QUOTE_STORE else None
+
+# Shared by every fetch, so an outage is detected once for the whole process
+quote_breaker = CircuitBreaker()
+
+# Striped locks, so concurrent misses on the same symbol trigger a single fetch
+_fetch_locks = [threading.Lock() for _ in range(64)]
+
+# Called with every quote fetched from the provider, see on_quote
+quote_listeners = []
+
+
+def lookup(symbol, refresh=False):
+    """Look up quote for symbol, using the cache while the quote is fresh (unless refresh is set)."""
+    symbol = _clean(symbol)
+    if not symbol:
+        return None
+
+    # Serve the quote from memory if somebody fetched it recently
+    key = symbol.upper()
+    quote = None if refresh else quote_cache.get(key)
+    if quote:
+        return dict(quote)
+    return _fetch(symbol, key, stored=not refresh, refresh=refresh)
+
+
+def _clean(symbol):
+    """Return symbol without the spaces typed around it, or None if it can't be a symbol."""
+
+    # Ignore the spaces typed around the symbol, and reject an empty one
+    symbol = symbol.strip()
+    if not symbol:
+        return None
 
     # Reject symbol if it starts with caret
     if symbol.startswith("^"):
@@ -81,38 +270,191 @@ def lookup(symbol):
     # Reject symbol if it contains comma
     if "," in symbol:
         return None
+    return symbol
 
-    # Query Alpha Vantage for quote
-    # https://www.alphavantage.co/documentation/
-    try:
 
-        # GET CSV
-        url = f"https://www.alphavantage.co/query?apikey={os.getenv('API_KEY')}&datatype=csv&function=TIME_SERIES_INTRADAY&interval=1min&symbol={symbol}"
-        webpage = urllib.request.urlopen(url)
+def _fetch(symbol, key, stored=True, refresh=False):
+    """
+    Fetch the quote of symbol (cached as key) that the cache didn't have, looking in the store
+    first if stored is set. Returns None if it couldn't be priced.
+    """
 
-        # Parse CSV
-        datareader = csv.reader(webpage.read().decode("utf-8").splitlines())
+    # Only one thread fetches a given symbol, the rest wait and reuse its result
+    with _fetch_locks[hash(key) % len(_fetch_locks)]:
+        quote = None if refresh else quote_cache.get(key, count=False)
+        if not quote and stored:
+            quote = _from_store([key]).get(key)
+        if not quote:
 
-        # Ignore first row
-        next(datareader)
+            # Only the provider counts as quote time, the store's queries are already db time
+            with metrics.timer("quote"):
+                quote = fetch_quote(symbol)
+            if not quote:
+                return None
+            quote_cache.put(key, quote)
+            if quote_store:
+                quote_store.put(quote, provider().name)
+            for listener in list(quote_listeners):
+                listener(key, quote["price"])
+    return dict(quote)
 
-        # Parse second row
-        row = next(datareader)
 
-        # Ensure stock exists
+def _from_store(keys):
+    """Return the quotes another process fetched recently, caching them in memory too."""
+    if not quote_store:
+        return {}
+    found = {}
+    now = time.time()
+    for key, row in quote_store.get_many(keys, max_age=QUOTE_TTL).items():
+        found[key] = {"price": row["price"], "symbol": key}
+        quote_cache.put(key, found[key], age=now - row["fetched_at"])
+    return found
+
+
+# Bounded pool shared by every request, so a page view can't spawn unlimited threads
+_quote_pool = ThreadPoolExecutor(max_workers=QUOTE_WORKERS, thread_name_prefix="quote")
+
+
+def lookup_many(symbols, timeout=QUOTE_DEADLINE, refresh=False):
+    """
+    Look up quotes for several symbols in parallel, fetching them all again if refresh is set.
+
+    Returns a dict mapping every (uppercased) symbol to its quote, or to None if
+    it couldn't be priced before the deadline.
+    """
+    results, missing = {}, {}
+    for symbol in symbols:
+        key = symbol.upper()
+        if key in results or key in missing:
+            continue
+        if not _clean(symbol):
+            results[key] = None
+            continue
+
+        # Fresh quotes are answered right away
+        quote = None if refresh else quote_cache.get(key)
+        if quote:
+            results[key] = dict(quote)
+        else:
+            missing[key] = symbol
+
+    # Then the ones other processes fetched are read in one go. Only the rest go to the pool,
+    # which neither counts them as cache misses again nor reads the store again
+    if not refresh:
+        results.update(_from_store(missing))
+    futures = {key: _quote_pool.submit(_fetch, _clean(symbol), key, stored=False, refresh=refresh)
+               for key, symbol in missing.items() if key not in results}
+
+    # Wait for all the fetches at once, so the deadline covers the whole batch
+    with metrics.timer("quote"):
+        done, _ = wait(futures.values(), timeout=timeout)
+    for key, future in futures.items():
+        results[key] = future.result() if future in done and not future.exception() else None
+    return results
+
+
+def fetch_quote(symbol):
+    """
+    Fetch the latest quote for symbol, retrying transient API errors.
+
+    Retries are capped, spaced with exponential backoff plus jitter and bounded by
+    an overall timeout. While the circuit breaker is open it fails fast instead.
+    """
+
+    # Don't touch the API while it is known to be failing
+    if not quote_breaker.allow():
+        return None
+
+    deadline = time.monotonic() + QUOTE_TIMEOUT
+    for attempt in range(QUOTE_RETRIES + 1):
         try:
-            price = float(row[4])
-        except:
+            quote = _fetch_quote(symbol, timeout=max(deadline - time.monotonic(), 0.1))
+        except QuoteError:
+            pass
+
+        # Our own threads hold every connection: neither retry (it would only add to them) nor blame the API
+        except PoolExhausted:
+            quote_breaker.abort()
             return None
 
-        # Return stock's name (as a str), price (as a float), and (uppercased) symbol (as a str)
-        return {
-            "price": price,
-            "symbol": symbol.upper()
-        }
+        # Anything else (a garbled answer, a missing API key) is a bug to surface, but still a failed lookup
+        except Exception:
+            quote_breaker.failure()
+            raise
+        else:
+            quote_breaker.success()
+            if quote is None:
+                unknown_symbols.put(symbol.upper(), True)
+            return quote
+
+        # Wait a random time up to the (capped) exponential backoff, unless we would run out of time
+        delay = random.uniform(0, min(QUOTE_BACKOFF_MAX, QUOTE_BACKOFF * 2 ** attempt))
+        if attempt == QUOTE_RETRIES or time.monotonic() + delay >= deadline:
+            break
+        time.sleep(delay)
 
-    except:
-        return None
+    # The breaker counts failed lookups, not attempts, so one bad lookup can't open it by itself
+    quote_breaker.failure()
+    return None
+
+
+def quote_status():
+    """Return the state of the quote cache and circuit breaker, for monitoring."""
+    return {
+        "provider": provider().name,
+        "connections": provider().stats(),
+        "cache": quote_cache.stats(),
+        "store": quote_store.stats() if quote_store else None,
+        "breaker": quote_breaker.status()
+    }
+
+
+def unknown(symbol):
+    """Tell whether symbol doesn't exist, according to the provider's last answer about it (not a failure)."""
+    return bool(unknown_symbols.get(symbol.strip().upper(), count=False))
+
+
+def on_quote(listener):
+    """Call listener(symbol, price) with every quote fetched from the provider. It must return quickly."""
+    if listener not in quote_listeners:
+        quote_listeners.append(listener)
+
+
+def off_quote(listener):
+    """Stop calling listener with the quotes, see on_quote."""
+    if listener in quote_listeners:
+        quote_listeners.remove(listener)
+
+
+def provider():
+    """Return the quote provider, building it the first time (so an unused one needs no API key)."""
+    global quote_provider
+    if quote_provider is None:
+        with _provider_lock:
+            if quote_provider is None:
+                quote_provider = make_provider()
+    return quote_provider
+
+
+def set_provider(provider):
+    """Make lookup() get its quotes from provider, forgetting the ones cached from the old one."""
+    global quote_provider
+    quote_provider = provider
+    quote_cache.clear()
+
+
+def fetch_bars(symbol, full=False):
+    """Return an iterator over the 1 minute price bars the provider has for symbol."""
+    return provider().bars(symbol, full=full, timeout=QUOTE_TIMEOUT)
+
+
+def _fetch_quote(symbol, timeout=None):
+    """
+    Fetch the latest quote for symbol from the provider.
+
+    Returns None if the symbol doesn't exist, raises QuoteError if the provider failed.
+    """
+    return provider().quote(symbol, timeout=timeout)
 
 
 def usd(value):
@@ -0,0 +1,107 @@
+"""
+Ranking of every user by total holdings, and site-wide trading stats.
+
+Everything is computed from a handful of aggregates over the whole site instead
+of running index() for every user: the holdings are grouped by symbol, every
+distinct symbol is priced once with lookup_many, and the users are totalled by a
+single query over the holdings. The result is cached for LEADERBOARD_TTL seconds,
+so the page costs the same whatever the number of users.
+"""
+import json
+import os
+import threading
+import time
+
+from datetime import datetime
+
+from helpers import lookup_many
+
+
+# Seconds the leaderboard is served from memory before being computed again
+LEADERBOARD_TTL = float(os.environ.get("LEADERBOARD_TTL", 300))
+
+# Users shown in the ranking, and symbols shown in every stats table
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", 50))
+LEADERBOARD_SYMBOLS = int(os.environ.get("LEADERBOARD_SYMBOLS", 10))
+
+
+def compute(db, size=LEADERBOARD_SIZE, symbols=LEADERBOARD_SYMBOLS):
+    """
+    Compute the leaderboard and the site stats from the database, as a dict.
+
+    Symbols the API can't price are valued at the average cost their holders paid.
+    """
+
+    # Holdings of all users grouped by symbol, with what was paid for them
+    held = db.execute("""SELECT symbol, SUM(amount) AS shares, COUNT(*) AS holders,
+            SUM(amount * avg_cost) AS cost, COUNT(avg_cost) AS costed
+        FROM stocks LEFT JOIN portfolio USING (id_user, symbol)
+        WHERE amount > 0 GROUP BY symbol""")
+
+    # Every distinct symbol is priced once, for all the users that hold it
+    quotes = lookup_many(row["symbol"] for row in held)
+    prices, unpriced = {}, []
+    for row in held:
+        quote = quotes.get(row["symbol"].upper())
+        if quote:
+            prices[row["symbol"]] = quote["price"]
+        else:
+            unpriced.append(row["symbol"])
+            prices[row["symbol"]] = row["cost"] / row["shares"] if row["costed"] == row["holders"] else 0.0
+        row["price"] = prices[row["symbol"]]
+        row["value"] = row["shares"] * row["price"]
+
+    # Cash and stocks of every user totalled in one pass over the holdings, with the prices passed as JSON.
+    # Everybody is ranked, so any user can be told where they stand
+    users = db.execute("""WITH prices AS (SELECT key AS symbol, value AS price FROM json_each(:prices))
+        SELECT id, username, cash, COALESCE(SUM(amount * price), 0) AS stocks
+        FROM users LEFT JOIN stocks ON stocks.id_user=users.id AND amount > 0 LEFT JOIN prices USING (symbol)
+        GROUP BY id ORDER BY cash + stocks DESC, id""", prices=json.dumps(prices))
+    ranks = {}
+    for rank, user in enumerate(users, 1):
+        user["rank"] = ranks[user["id"]] = rank
+        user["total"] = user["cash"] + user["stocks"]
+
+    # Shares and money traded per symbol, over the whole history
+    volume = db.execute("""SELECT symbol, COUNT(*) AS trades, SUM(ABS(shares)) AS shares,
+            SUM(ABS(shares) * price) AS value
+        FROM transactions GROUP BY symbol ORDER BY value DESC LIMIT :limit""", limit=symbols)
+
+    return {
+        "computed_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "users": len(users),
+        "leaders": users[:size],
+        "ranks": ranks,
+        "total": sum(user["total"] for user in users),
+        "most_held": sorted(held, key=lambda row: (-row["holders"], -row["value"]))[:symbols],
+        "volume": volume,
+        "unpriced": sorted(unpriced)
+    }
+
+
+class Leaderboard:
+    """The result of compute(), cached for ttl seconds and computed by one thread at a time."""
+
+    def __init__(self, db, ttl=LEADERBOARD_TTL):
+        self.db = db
+        self.ttl = ttl
+        self._result = None
+        self._computed_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the leaderboard, computing it again if it is older than ttl."""
+        if self._result is not None and time.monotonic() - self._computed_at <= self.ttl:
+            return self._result
+
+        # Requests arriving while it is being computed wait for that result instead of computing it too
+        with self._lock:
+            if self._result is None or time.monotonic() - self._computed_at > self.ttl:
+                self._result = compute(self.db)
+                self._computed_at = time.monotonic()
+            return self._result
+
+    def clear(self):
+        """Forget the cached result, so the next get() computes it again."""
+        with self._lock:
+            self._result = None
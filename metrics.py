@@ -0,0 +1,209 @@
+"""
+Opt-in timing of every request, broken down into quotes, database, password hashing and templates.
+
+With METRICS set, every request adds its timings to histograms, which /metrics
+serves (to local clients only) in the Prometheus text format, and returns them in
+a Server-Timing header. With PROFILE_RATE set, that fraction of the requests is
+run under cProfile and dumped to PROFILE_DIR, for snakeviz or pstats.
+
+The code being timed marks its sections with timer(kind). Outside of a request,
+or with METRICS unset, timer() costs a couple of attribute lookups.
+"""
+import cProfile
+import os
+import random
+import tempfile
+import threading
+import time
+
+from flask import Response, abort, before_render_template, request, template_rendered
+
+
+# Record request timings and serve /metrics
+METRICS = bool(os.environ.get("METRICS"))
+
+# Fraction of the requests run under cProfile, and where their profiles are written
+PROFILE_RATE = float(os.environ.get("PROFILE_RATE", 0))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "pynance-profiles"))
+
+# Upper bounds of the histogram buckets, in seconds (or calls, for the database queries)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Sections of a request timed by timer()
+KINDS = ("quote", "db", "hash", "template")
+
+# Only these addresses can read /metrics
+LOCAL = ("127.0.0.1", "::1")
+
+
+class Histogram:
+    """Thread-safe cumulative histogram, like Prometheus' own."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Add a value to the histogram."""
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def lines(self, name, labels):
+        """Return the lines of the histogram in the Prometheus text format."""
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        lines, cumulative = [], 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {count}')
+        lines.append(f"{name}_sum{{{labels.rstrip(',')}}} {total}")
+        lines.append(f"{name}_count{{{labels.rstrip(',')}}} {count}")
+        return lines
+
+
+# Histograms by metric name, then by endpoint
+_histograms = {}
+_lock = threading.Lock()
+
+# Timings of the request the current thread is serving, None outside of requests
+_local = threading.local()
+
+
+def observe(name, endpoint, value, buckets=BUCKETS):
+    """Add a value to the histogram of name for endpoint, creating it the first time."""
+    key = (name, endpoint)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _lock:
+            histogram = _histograms.setdefault(key, Histogram(buckets))
+    histogram.observe(value)
+
+
+class _Timer:
+    """Add the time spent in a with block to the current request's total for kind."""
+
+    __slots__ = ("timings", "kind", "started")
+
+    def __init__(self, timings, kind):
+        self.timings = timings
+        self.kind = kind
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timings[self.kind] += time.perf_counter() - self.started
+        if self.kind == "db":
+            self.timings["queries"] += 1
+
+
+class _Nothing:
+    """Timer used when there is nothing to record."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_nothing = _Nothing()
+
+
+def timer(kind):
+    """Time a with block as part of the current request's kind ("quote", "db", "hash" or "template")."""
+    timings = getattr(_local, "timings", None)
+    if timings is None:
+        return _nothing
+    return _Timer(timings, kind)
+
+
+def render():
+    """Return every histogram in the Prometheus text format."""
+    lines = []
+    with _lock:
+        histograms = sorted(_histograms.items())
+    names = set()
+    for (name, endpoint), histogram in histograms:
+        if name not in names:
+            names.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        lines.extend(histogram.lines(name, f'endpoint="{endpoint}",'))
+    return "\n".join(lines) + "\n"
+
+
+def _started():
+    """Start recording the request, and maybe profiling it."""
+    _local.timings = dict.fromkeys(KINDS, 0.0)
+    _local.timings["queries"] = 0
+    _local.started = time.perf_counter()
+    _local.profile = None
+    if PROFILE_RATE and random.random() < PROFILE_RATE:
+        _local.profile = cProfile.Profile()
+        _local.profile.enable()
+
+
+def _finished(response):
+    """Record the timings of the request, and tell them to the client in a Server-Timing header."""
+    timings = getattr(_local, "timings", None)
+    if timings is None:
+        return response
+    total = time.perf_counter() - _local.started
+    _local.timings = None
+
+    endpoint = request.endpoint or "unknown"
+    observe("pynance_request_seconds", endpoint, total)
+    for kind in KINDS:
+        observe(f"pynance_request_{kind}_seconds", endpoint, timings[kind])
+    observe("pynance_request_db_queries", endpoint, timings["queries"], COUNT_BUCKETS)
+    response.headers["Server-Timing"] = ", ".join(
+        [f"{kind};dur={timings[kind] * 1000:.2f}" for kind in KINDS] + [f"total;dur={total * 1000:.2f}"])
+
+    # The profile is named after the endpoint, so the slow ones are easy to find
+    if _local.profile is not None:
+        _local.profile.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        _local.profile.dump_stats(os.path.join(PROFILE_DIR, f"{endpoint}-{time.time():.6f}.prof"))
+        _local.profile = None
+    return response
+
+
+def _rendering(sender, template, context, **extra):
+    """Start timing a template, Flask sends this signal right before rendering it."""
+    _local.rendering = time.perf_counter()
+
+
+def _rendered(sender, template, context, **extra):
+    """Add the time spent rendering a template to the current request."""
+    timings = getattr(_local, "timings", None)
+    if timings is not None and getattr(_local, "rendering", None) is not None:
+        timings["template"] += time.perf_counter() - _local.rendering
+        _local.rendering = None
+
+
+def _metrics():
+    """Serve the histograms to local clients (like a Prometheus agent on the same host)."""
+    if request.remote_addr not in LOCAL or request.headers.get("X-Forwarded-For"):
+        abort(404)
+    return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+def install(app):
+    """Instrument the requests of app and serve /metrics, if METRICS or PROFILE_RATE are set."""
+    if not (METRICS or PROFILE_RATE):
+        return
+    app.before_request(_started)
+    app.after_request(_finished)
+    template_rendered.connect(_rendered, app)
+    before_render_template.connect(_rendering, app)
+    app.add_url_rule("/metrics", "metrics", _metrics)
@@ -0,0 +1,135 @@
+import sqlite3
+
+from portfolio import replay
+
+
+def backfill_portfolio(connection):
+    """Fill the portfolio table from the transactions made before it existed."""
+    rows = connection.execute("SELECT id_user, symbol, shares, price, time FROM transactions ORDER BY time, id_tran")
+    connection.executemany("""INSERT INTO portfolio (id_user, symbol, shares, avg_cost, realized, last_trade)
+        VALUES (?, ?, ?, ?, ?, ?)""", [(u_id, symbol, row["shares"], row["avg_cost"], row["realized"], row["last_trade"])
+                                       for (u_id, symbol), row in replay(rows).items()])
+
+
+def rename_duplicate_users(connection):
+    """
+    Make usernames unique before they are indexed. The oldest account keeps the name, the
+    others (which couldn't log in anyway, the name matched several rows) get "name-id".
+    """
+    rows = connection.execute("""SELECT id, username FROM users WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY username)
+        ORDER BY id""").fetchall()
+    for u_id, username in rows:
+        new = f"{username}-{u_id}"
+        while connection.execute("SELECT 1 FROM users WHERE username=?", (new,)).fetchone():
+            new += f"-{u_id}"
+        connection.execute("UPDATE users SET username=? WHERE id=?", (new, u_id))
+
+
+# Every migration is a list of statements (or functions taking the connection) applied in order.
+# Migration i brings the database to schema version i + 1, which SQLite remembers in PRAGMA user_version
+MIGRATIONS = [
+
+    # 1: the original tables
+    [
+        """CREATE TABLE IF NOT EXISTS 'users' (
+            'id' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            'username' TEXT NOT NULL,
+            'hash' TEXT NOT NULL,
+            'cash' NUMERIC NOT NULL DEFAULT 10000.00 )""",
+
+        """CREATE TABLE IF NOT EXISTS 'transactions' (
+            'id_tran' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            'id_user' INTEGER NOT NULL,
+            'symbol' TEXT NOT NULL,
+            'shares' INTEGER NOT NULL,
+            'price' NUMERIC NOT NULL,
+            'time' TEXT NOT NULL,
+            FOREIGN KEY(id_user) REFERENCES users(id))""",
+
+        """CREATE TABLE IF NOT EXISTS 'stocks' (
+            'id_stock' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            'id_user' INTEGER NOT NULL,
+            'symbol' TEXT NOT NULL,
+            'amount' INTEGER NOT NULL,
+            FOREIGN KEY(id_user) REFERENCES users(id))"""
+    ],
+
+    # 2: indexes for the per-user queries. Duplicated holdings are merged and duplicated usernames renamed first,
+    # so they can be unique
+    [
+        """UPDATE stocks SET amount=(SELECT SUM(amount) FROM stocks AS s
+            WHERE s.id_user=stocks.id_user AND s.symbol=stocks.symbol)
+            WHERE id_stock IN (SELECT MIN(id_stock) FROM stocks GROUP BY id_user, symbol HAVING COUNT(*) > 1)""",
+        "DELETE FROM stocks WHERE id_stock NOT IN (SELECT MIN(id_stock) FROM stocks GROUP BY id_user, symbol)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS stocks_user_symbol ON stocks (id_user, symbol)",
+        "CREATE INDEX IF NOT EXISTS transactions_user_time ON transactions (id_user, time)",
+        rename_duplicate_users,
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users (username)"
+    ],
+
+    # 3: per user and symbol summary of the trades, see portfolio.py
+    [
+        """CREATE TABLE IF NOT EXISTS 'portfolio' (
+            'id_user' INTEGER NOT NULL,
+            'symbol' TEXT NOT NULL,
+            'shares' INTEGER NOT NULL,
+            'avg_cost' REAL NOT NULL,
+            'realized' REAL NOT NULL DEFAULT 0,
+            'last_trade' TEXT NOT NULL,
+            PRIMARY KEY(id_user, symbol),
+            FOREIGN KEY(id_user) REFERENCES users(id))""",
+        backfill_portfolio
+    ],
+
+    # 4: limit and stop orders waiting for their price, see orders.py
+    [
+        """CREATE TABLE IF NOT EXISTS 'orders' (
+            'id_order' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            'id_user' INTEGER NOT NULL,
+            'symbol' TEXT NOT NULL,
+            'shares' INTEGER NOT NULL,
+            'kind' TEXT NOT NULL,
+            'trigger' REAL NOT NULL,
+            'status' TEXT NOT NULL DEFAULT 'open',
+            'created' TEXT NOT NULL,
+            'price' REAL,
+            'closed' TEXT,
+            'note' TEXT,
+            FOREIGN KEY(id_user) REFERENCES users(id))""",
+        "CREATE INDEX IF NOT EXISTS orders_open ON orders (symbol) WHERE status='open'",
+        "CREATE INDEX IF NOT EXISTS orders_user ON orders (id_user, status)"
+    ]
+]
+
+
+def migrate(path, target=len(MIGRATIONS)):
+    """Bring the database at path up to the target schema version, returning the version it was at."""
+    connection = sqlite3.connect(path, isolation_level=None, timeout=30)
+    try:
+
+        # An up to date database is only read, so workers starting together don't queue on the write lock
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version >= target:
+            return version
+
+        # The write lock makes concurrent workers wait, so only the first one migrates
+        connection.execute("BEGIN IMMEDIATE")
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        for migration in MIGRATIONS[version:target]:
+            for statement in migration:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.execute(statement)
+        if version < target:
+            connection.execute(f"PRAGMA user_version={target}")
+        connection.execute("COMMIT")
+        return version
+
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+        raise
+
+    finally:
+        connection.close()
@@ -0,0 +1,247 @@
+"""
+Limit and stop orders, resting in the orders table until the price reaches them.
+
+Buy limits and sell stops fire when the price falls to their trigger, sell limits
+and buy stops when it rises to it. The engine keeps the open orders of every symbol
+in two heaps, one for each direction, so a new price finds the k orders it triggers
+in O(k log n) without looking at the others. Cancelled orders are left in the heaps
+and skipped when they come up.
+
+Fills are idempotent: an order is only executed by the transaction that moves it
+out of the 'open' status, so several processes can run an engine on the same database.
+"""
+import heapq
+import os
+import threading
+import time
+
+from datetime import datetime
+
+from helpers import lookup_many
+from trades import TradeError, buy, sell
+
+
+# Seconds between two looks for orders placed by other processes, and two polls of the prices they wait for
+ORDER_SYNC = float(os.environ.get("ORDER_SYNC", 5))
+ORDER_POLL = float(os.environ.get("ORDER_POLL", 30))
+
+# Most fills executed in a single transaction
+ORDER_BATCH = int(os.environ.get("ORDER_BATCH", 500))
+
+# The kinds of resting orders
+KINDS = ("limit", "stop")
+
+
+def falls(shares, kind):
+    """Return whether an order fires when the price falls to its trigger (buy limits and sell stops)."""
+    return (shares > 0) == (kind == "limit")
+
+
+def place(db, u_id, symbol, shares, kind, trigger):
+    """Store an open order, positive shares buy and negative shares sell. Returns its id."""
+    if kind not in KINDS:
+        raise TradeError("order kind must be limit or stop")
+    if not shares or not trigger > 0:
+        raise TradeError("not positive shares or price")
+    return db.execute("""INSERT INTO orders (id_user, symbol, shares, kind, trigger, created)
+        VALUES (:u_id, :symbol, :shares, :kind, :trigger, :t)""", u_id=u_id, symbol=symbol.upper(), shares=shares,
+                      kind=kind, trigger=trigger, t=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+
+def cancel(db, u_id, id_order):
+    """Cancel an open order of the user, returning whether there was one."""
+    return bool(db.execute("""UPDATE orders SET status='cancelled', closed=:t
+        WHERE id_order=:id_order AND id_user=:u_id AND status='open'""",
+                           t=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), id_order=id_order, u_id=u_id))
+
+
+class OrderBook:
+    """Open orders by symbol, in heaps of trigger prices."""
+
+    def __init__(self):
+        self.orders = {}
+        self.last_id = 0
+        self._falling = {}
+        self._rising = {}
+
+    def __len__(self):
+        return len(self.orders)
+
+    def symbols(self):
+        """Return the symbols with open orders."""
+        return {order["symbol"] for order in self.orders.values()}
+
+    def add(self, order):
+        """Add an open order (a dict with the columns of the orders table)."""
+        self.orders[order["id_order"]] = order
+        self.last_id = max(self.last_id, order["id_order"])
+
+        # The falling heap is a max-heap, the highest trigger is the first one a falling price reaches
+        if falls(order["shares"], order["kind"]):
+            heapq.heappush(self._falling.setdefault(order["symbol"], []), (-order["trigger"], order["id_order"]))
+        else:
+            heapq.heappush(self._rising.setdefault(order["symbol"], []), (order["trigger"], order["id_order"]))
+
+    def discard(self, id_order):
+        """Forget an order. Its heap entry goes away when it comes up."""
+        self.orders.pop(id_order, None)
+
+    def triggered(self, symbol, price):
+        """Remove and return the open orders of symbol that price triggers."""
+        found = []
+        falling = self._falling.get(symbol, [])
+        while falling and -falling[0][0] >= price:
+            order = self.orders.pop(heapq.heappop(falling)[1], None)
+            if order:
+                found.append(order)
+        rising = self._rising.get(symbol, [])
+        while rising and rising[0][0] <= price:
+            order = self.orders.pop(heapq.heappop(rising)[1], None)
+            if order:
+                found.append(order)
+        return found
+
+
+class OrderEngine:
+    """
+    Executes the orders triggered by new prices in a background thread.
+
+    on_price() only records the latest price of the symbol, the thread then takes
+    every price that arrived meanwhile and fills what they trigger in batched transactions.
+    """
+
+    def __init__(self, db, sync=ORDER_SYNC, poll=ORDER_POLL, batch=ORDER_BATCH):
+        self.db = db
+        self.sync_interval = sync
+        self.poll_interval = poll
+        self.batch = batch
+        self.book = OrderBook()
+        self.filled = self.rejected = self.batches = 0
+        self.last_error = None
+        self._prices = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Load the open orders and start executing them in a daemon thread."""
+        self.sync()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="order-engine", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Ask the thread to stop, and wait for it to finish its current batch."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def on_price(self, symbol, price):
+        """Take a new price of symbol, to be checked against the open orders by the thread."""
+        with self._lock:
+            self._prices[symbol.upper()] = price
+        self._wake.set()
+
+    def sync(self):
+        """Add the orders placed since the last sync (by any process) to the book."""
+        rows = self.db.execute("SELECT * FROM orders WHERE status='open' AND id_order > :last ORDER BY id_order",
+                               last=self.book.last_id)
+        with self._lock:
+            for row in rows:
+                self.book.add(row)
+
+    def discard(self, id_order):
+        """Drop a cancelled order from the book."""
+        with self._lock:
+            self.book.discard(id_order)
+
+    def process(self, prices):
+        """Fill the orders triggered by prices, a dict of symbols to prices. Returns how many were filled."""
+        with self._lock:
+            fills = [(order, price) for symbol, price in prices.items()
+                     for order in self.book.triggered(symbol, price)]
+        filled = 0
+        for i in range(0, len(fills), self.batch):
+
+            # Orders of a batch that couldn't be written go back to the book, to be tried again
+            try:
+                filled += self.execute(fills[i:i + self.batch])
+            except Exception:
+                with self._lock:
+                    for order, _ in fills[i:]:
+                        self.book.add(order)
+                raise
+        return filled
+
+    def execute(self, fills):
+        """Execute (order, price) fills in a single transaction, returning how many were filled."""
+        t = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        filled = rejected = 0
+        with self.db.transaction():
+            for order, price in fills:
+
+                # Claim the order: if it isn't open anymore, another process filled it or the user cancelled it
+                if not self.db.execute("""UPDATE orders SET status='filled', price=:price, closed=:t
+                        WHERE id_order=:id_order AND status='open'""", price=price, t=t, id_order=order["id_order"]):
+                    continue
+
+                # buy() and sell() check before writing, so a failed order leaves nothing to undo
+                try:
+                    if order["shares"] > 0:
+                        buy(self.db, order["id_user"], order["symbol"], order["shares"], price, t)
+                    else:
+                        sell(self.db, order["id_user"], order["symbol"], -order["shares"], price, t)
+                    filled += 1
+                except TradeError as e:
+                    self.db.execute("UPDATE orders SET status='rejected', price=NULL, note=:note WHERE id_order=:id_order",
+                                    note=str(e), id_order=order["id_order"])
+                    rejected += 1
+        with self._lock:
+            self.filled += filled
+            self.rejected += rejected
+            self.batches += 1
+        return filled
+
+    def status(self):
+        """Return the engine counters as a dict."""
+        with self._lock:
+            return {
+                "open": len(self.book),
+                "filled": self.filled,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "running": bool(self._thread and self._thread.is_alive()),
+                "last_error": self.last_error
+            }
+
+    def _run(self):
+        """Process the prices as they come, pick up new orders every sync interval and poll their prices."""
+        synced = polled = time.monotonic()
+        while not self._stop.is_set():
+            self._wake.wait(self.sync_interval)
+            self._wake.clear()
+            prices = {}
+            try:
+                if time.monotonic() - synced >= self.sync_interval:
+                    self.sync()
+                    synced = time.monotonic()
+
+                # Quotes fetched here reach on_price like any other, prices still cached don't trigger anything
+                if time.monotonic() - polled >= self.poll_interval:
+                    polled = time.monotonic()
+                    with self._lock:
+                        symbols = self.book.symbols()
+                    lookup_many(symbols)
+
+                with self._lock:
+                    prices, self._prices = self._prices, {}
+                if prices:
+                    self.process(prices)
+
+            # A busy database is tried again on the next round, with the prices that didn't go through
+            except Exception as e:
+                with self._lock:
+                    self._prices = {**prices, **self._prices}
+                    self.last_error = repr(e)
@@ -0,0 +1,85 @@
+"""
+Per user and symbol summary of the trades: shares held, average cost, realized P&L.
+
+It is kept up to date by trades.py, inside the transaction of every order, so
+reading it never needs to go through the whole transaction history. Average cost
+is the mean price paid for the shares held, selling doesn't change it.
+"""
+
+
+# Money differences below this are rounding, not inconsistencies
+TOLERANCE = 1e-6
+
+
+def record_buy(db, u_id, symbol, shares, price, t):
+    """
+    Add a purchase to the user's portfolio, averaging its price into the cost of the shares held.
+
+    With no shares held (or a row that drifted below zero), the cost is just the price paid.
+    """
+    db.execute("""INSERT INTO portfolio (id_user, symbol, shares, avg_cost, realized, last_trade)
+        VALUES (:u_id, :symbol, :shares, :price, 0, :t)
+        ON CONFLICT(id_user, symbol) DO UPDATE SET
+            avg_cost=CASE WHEN shares > 0
+                THEN (shares * avg_cost + excluded.shares * excluded.avg_cost) / (shares + excluded.shares)
+                ELSE excluded.avg_cost END,
+            shares=shares + excluded.shares,
+            last_trade=excluded.last_trade""", u_id=u_id, symbol=symbol, shares=shares, price=price, t=t)
+
+
+def record_sell(db, u_id, symbol, shares, price, t):
+    """Take a sale from the user's portfolio, realizing its gain (or loss) over the average cost."""
+    db.execute("""UPDATE portfolio SET
+            realized=realized + :shares * (:price - avg_cost),
+            shares=shares - :shares,
+            last_trade=:t
+        WHERE id_user=:u_id AND symbol=:symbol""", u_id=u_id, symbol=symbol, shares=shares, price=price, t=t)
+
+
+def replay(rows):
+    """
+    Compute the portfolio from transactions, ordered by time.
+
+    rows are (id_user, symbol, shares, price, time) tuples. Returns a dict mapping
+    (id_user, symbol) to a dict with the portfolio columns.
+    """
+    summary = {}
+    for u_id, symbol, shares, price, t in rows:
+        row = summary.setdefault((u_id, symbol), {"shares": 0, "avg_cost": 0.0, "realized": 0.0, "last_trade": t})
+        if shares > 0:
+            row["avg_cost"] = (row["shares"] * row["avg_cost"] + shares * price) / (row["shares"] + shares)
+        else:
+            row["realized"] += -shares * (price - row["avg_cost"])
+        row["shares"] += shares
+        row["last_trade"] = t
+    return summary
+
+
+def rebuild(db, u_id=None):
+    """
+    Recompute the portfolio of a user (or everybody) from their transactions and store it.
+
+    Returns a list of (id_user, symbol, column, stored, computed) for every value that
+    didn't match what was stored, which should be empty.
+    """
+    where, params = ("WHERE id_user=:u_id", {"u_id": u_id}) if u_id is not None else ("", {})
+    with db.transaction():
+        rows = db.iterate(f"SELECT id_user, symbol, shares, price, time FROM transactions {where} ORDER BY time, id_tran", **params)
+        computed = replay((row["id_user"], row["symbol"], row["shares"], row["price"], row["time"]) for row in rows)
+        stored = {(row["id_user"], row["symbol"]): row
+                  for row in db.execute(f"SELECT * FROM portfolio {where}", **params)}
+
+        # Compare both sides, a row missing on one side counts as all zeros
+        mismatches = []
+        empty = {"shares": 0, "avg_cost": 0, "realized": 0}
+        for key in sorted(computed.keys() | stored.keys()):
+            old, new = stored.get(key, empty), computed.get(key, empty)
+            for column in ("shares", "avg_cost", "realized"):
+                if abs(old[column] - new[column]) > TOLERANCE:
+                    mismatches.append((*key, column, old[column], new[column]))
+
+        db.execute(f"DELETE FROM portfolio {where}", **params)
+        for (user, symbol), row in computed.items():
+            db.execute("""INSERT INTO portfolio (id_user, symbol, shares, avg_cost, realized, last_trade)
+                VALUES (:u_id, :symbol, :shares, :avg_cost, :realized, :last_trade)""", u_id=user, symbol=symbol, **row)
+    return mismatches
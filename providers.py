@@ -0,0 +1,408 @@
+import csv
+import http.client
+import io
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+import zlib
+
+from collections import deque
+from contextlib import contextmanager
+
+from bars import parse_csv
+
+
+# Which provider lookup() uses: "alphavantage", "replay" or "randomwalk"
+QUOTE_PROVIDER = os.environ.get("QUOTE_PROVIDER", "alphavantage")
+
+# Alpha Vantage endpoint used for quotes. GLOBAL_QUOTE has the smallest payload,
+# TIME_SERIES_INTRADAY gives the close of the latest 1 minute bar
+ALPHAVANTAGE_FUNCTION = os.environ.get("ALPHAVANTAGE_FUNCTION", "TIME_SERIES_INTRADAY")
+
+# Keep-alive connections kept to the API host, and seconds an idle one is kept around
+QUOTE_POOL_SIZE = int(os.environ.get("QUOTE_POOL_SIZE", 8))
+QUOTE_POOL_IDLE = float(os.environ.get("QUOTE_POOL_IDLE", 30))
+
+# Seconds allowed to open a connection, and to wait for data on it
+QUOTE_CONNECT_TIMEOUT = float(os.environ.get("QUOTE_CONNECT_TIMEOUT", 3))
+QUOTE_READ_TIMEOUT = float(os.environ.get("QUOTE_READ_TIMEOUT", 10))
+
+# Fixture (CSV or SQLite file) replayed by the replay provider
+QUOTE_FIXTURE = os.environ.get("QUOTE_FIXTURE")
+
+# Simulated seconds of latency and fraction of failed requests of the offline providers
+QUOTE_LATENCY = float(os.environ.get("QUOTE_LATENCY", 0))
+QUOTE_FAILURE_RATE = float(os.environ.get("QUOTE_FAILURE_RATE", 0))
+
+# Seed of the offline providers, so runs can be reproduced
+QUOTE_SEED = int(os.environ.get("QUOTE_SEED", 0))
+
+# What a plausible ticker looks like, offline providers treat anything else as unknown
+ticker = re.compile(r"^[A-Z][A-Z.]{0,9}$")
+
+
+class QuoteError(Exception):
+    """The quote API failed in a way that is worth retrying (network error, rate limit...)."""
+
+
+class PoolExhausted(Exception):
+    """Every connection of the pool stayed busy with our own requests: the API isn't at fault."""
+
+
+class QuoteProvider:
+    """
+    Source of stock quotes.
+
+    quote(symbol) returns {"price": float, "symbol": str}, None if the symbol doesn't
+    exist, or raises QuoteError if the source failed.
+    """
+
+    name = "base"
+
+    def __init__(self, latency=0, failure_rate=0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def quote(self, symbol, timeout=None):
+        raise NotImplementedError
+
+    def stats(self):
+        """Return counters specific to the provider, if any."""
+        return {}
+
+    def bars(self, symbol, full=False, timeout=None):
+        """Yield the (time, open, high, low, close, volume) 1 minute bars of symbol, oldest or newest first."""
+        raise NotImplementedError(f"{self.name} provider has no price bars")
+
+    def _simulate(self, timeout=None):
+        """Sleep the configured latency and fail at the configured rate."""
+        with self._lock:
+            delay = self._random.uniform(0.5, 1.5) * self.latency
+            failed = self._random.random() < self.failure_rate
+
+        # Behave like a socket timeout if the request would take too long
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise QuoteError("simulated timeout")
+        time.sleep(delay)
+        if failed:
+            raise QuoteError("simulated failure")
+
+
+class ConnectionPool:
+    """Thread-safe pool of keep-alive HTTP(S) connections to a single host."""
+
+    # Unread responses up to this many bytes are drained so their connection can be reused
+    drain_limit = 64 * 1024
+
+    def __init__(self, host, port=None, https=True, size=QUOTE_POOL_SIZE, idle_timeout=QUOTE_POOL_IDLE,
+                 connect_timeout=QUOTE_CONNECT_TIMEOUT, read_timeout=QUOTE_READ_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.https = https
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.created = self.reused = self.discarded = self.expired = 0
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def get(self, path, timeout=None):
+        """Send a GET for path and yield the response, returning its connection to the pool afterwards."""
+        timeout = min(timeout or self.read_timeout, self.read_timeout)
+
+        # Never have more than size connections open, wait for one to be released instead
+        if not self._slots.acquire(timeout=timeout):
+            raise PoolExhausted("no connection available")
+        try:
+            connection, response = self._send(path, timeout)
+            try:
+                yield response
+            finally:
+                self._release(connection, response)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        """Return the pool counters as a dict."""
+        with self._lock:
+            return {
+                "idle": len(self._idle),
+                "created": self.created,
+                "reused": self.reused,
+                "discarded": self.discarded,
+                "expired": self.expired
+            }
+
+    def _send(self, path, timeout):
+        """Send the request on an idle connection (or a new one), returning it and its response."""
+        connection = self._checkout()
+        if connection:
+            try:
+                connection.sock.settimeout(timeout)
+                connection.request("GET", path)
+                return connection, connection.getresponse()
+
+            # The server may have closed the idle connection, retry on a new one
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                with self._lock:
+                    self.discarded += 1
+
+        connection = self._connect()
+        try:
+            connection.sock.settimeout(timeout)
+            connection.request("GET", path)
+            return connection, connection.getresponse()
+        except BaseException:
+            connection.close()
+            raise
+
+    def _checkout(self):
+        """Return the most recently used idle connection, closing the ones idle for too long."""
+        with self._lock:
+            while self._idle:
+                connection, released_at = self._idle.pop()
+                if time.monotonic() - released_at < self.idle_timeout:
+                    self.reused += 1
+                    return connection
+                connection.close()
+                self.expired += 1
+        return None
+
+    def _connect(self):
+        """Open a new connection to the host."""
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        connection = cls(self.host, self.port, timeout=self.connect_timeout)
+        connection.connect()
+        with self._lock:
+            self.created += 1
+        return connection
+
+    def _release(self, connection, response):
+        """Put the connection back in the pool if it can carry another request, close it otherwise."""
+
+        # A connection is only reusable once its response was read to the end
+        if not response.isclosed() and response.length is not None and response.length <= self.drain_limit:
+            try:
+                response.read()
+            except (OSError, http.client.HTTPException):
+                pass
+
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.append((connection, time.monotonic()))
+        else:
+            connection.close()
+            with self._lock:
+                self.discarded += 1
+
+
+class AlphaVantageProvider(QuoteProvider):
+    """Quotes from the Alpha Vantage API (https://www.alphavantage.co/documentation/)."""
+
+    name = "alphavantage"
+
+    def __init__(self, api_key=None, function=ALPHAVANTAGE_FUNCTION, pool=None):
+        super().__init__()
+        self.function = function
+        self.pool = pool or ConnectionPool("www.alphavantage.co")
+
+        # Ensure we have a key for the API
+        self.api_key = api_key or os.environ.get("API_KEY")
+        if not self.api_key:
+            raise RuntimeError("API_KEY not set")
+
+    def path(self, symbol):
+        """Return the path (and query) of the CSV quote for symbol."""
+        path = f"/query?apikey={self.api_key}&datatype=csv&function={self.function}&symbol={urllib.parse.quote(symbol)}"
+        if self.function == "TIME_SERIES_INTRADAY":
+            path += "&interval=1min&outputsize=compact"
+        return path
+
+    def stats(self):
+        """Return the connection pool counters."""
+        return self.pool.stats()
+
+    def bars(self, symbol, full=False, timeout=None):
+        """Yield the whole intraday series of symbol (the last ~100 bars, or ~30 days if full), newest first."""
+        path = (f"/query?apikey={self.api_key}&datatype=csv&function=TIME_SERIES_INTRADAY&interval=1min"
+                f"&symbol={urllib.parse.quote(symbol)}")
+        path += "&outputsize=full" if full else "&outputsize=compact"
+        try:
+            with self.pool.get(path, timeout) as webpage:
+                if webpage.status != 200:
+                    raise QuoteError(f"API answered {webpage.status}")
+                yield from parse_csv(io.TextIOWrapper(webpage, encoding="utf-8", newline=""))
+
+        # A request that can't even be built is about the symbol, not the API: there are no bars for it
+        except http.client.InvalidURL:
+            return
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            raise QuoteError(f"request failed: {e}") from e
+
+    def quote(self, symbol, timeout=None):
+        """Fetch the latest price for symbol, reading no more of the response than needed."""
+        try:
+
+            # GET CSV over a pooled keep-alive connection, decoding it as it arrives instead of reading the whole body
+            with self.pool.get(self.path(symbol), timeout) as webpage:
+                if webpage.status != 200:
+                    raise QuoteError(f"API answered {webpage.status}")
+                lines = io.TextIOWrapper(webpage, encoding="utf-8", newline="")
+                header = lines.readline()
+
+                # Errors come back as (small) JSON. Unknown symbols get an "Error Message", rate limits a "Note"
+                if header.startswith("{"):
+                    body = header + lines.read()
+                    if "Error Message" in body:
+                        return None
+                    raise QuoteError(f"API refused the request: {body[:200]}")
+
+                # Both the intraday series and the global quote have the latest price in the 5th column
+                # of the first row. The pool drops the connection if too much of the body is left unread
+                row = next(csv.reader(lines), None)
+                lines.detach()
+
+        # A request that can't even be built is about the symbol, not the API: it doesn't exist
+        except http.client.InvalidURL:
+            return None
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            raise QuoteError(f"request failed: {e}") from e
+
+        # Ensure stock exists
+        try:
+            price = float(row[4])
+        except (TypeError, IndexError, ValueError):
+            return None
+
+        # Return stock's name (as a str), price (as a float), and (uppercased) symbol (as a str)
+        return {
+            "price": price,
+            "symbol": symbol.upper()
+        }
+
+
+class ReplayProvider(QuoteProvider):
+    """
+    Replays prices from a fixture, cycling through them in order for every symbol.
+
+    The fixture is either a CSV file with "symbol" and "price" columns, or a SQLite
+    database with a table (named quotes by default) having those columns.
+    """
+
+    name = "replay"
+
+    def __init__(self, path, table="quotes", latency=0, failure_rate=0, seed=None):
+        super().__init__(latency, failure_rate, seed)
+        self.prices = {}
+        for symbol, price in self._load(path, table):
+            self.prices.setdefault(symbol.upper(), []).append(float(price))
+        self._positions = dict.fromkeys(self.prices, 0)
+
+    @staticmethod
+    def _load(path, table):
+        """Yield the (symbol, price) rows of the fixture."""
+        if path.endswith((".db", ".sqlite", ".sqlite3")):
+            connection = sqlite3.connect(path)
+            try:
+                yield from connection.execute(f"SELECT symbol, price FROM {table} ORDER BY rowid")
+            finally:
+                connection.close()
+        else:
+            with open(path, newline="") as f:
+                for row in csv.DictReader(f):
+                    yield row["symbol"], row["price"]
+
+    def quote(self, symbol, timeout=None):
+        """Return the next price of the fixture for symbol."""
+        self._simulate(timeout)
+        symbol = symbol.upper()
+        if symbol not in self.prices:
+            return None
+
+        # Move to the next price, going back to the first one at the end
+        with self._lock:
+            prices, position = self.prices[symbol], self._positions[symbol]
+            self._positions[symbol] = (position + 1) % len(prices)
+        return {
+            "price": prices[position],
+            "symbol": symbol
+        }
+
+
+class RandomWalkProvider(QuoteProvider):
+    """Makes up a price for any plausible ticker, moving it randomly on every quote."""
+
+    name = "randomwalk"
+
+    def __init__(self, start=100.0, volatility=0.01, latency=0, failure_rate=0, seed=None):
+        super().__init__(latency, failure_rate, seed)
+        self.start = start
+        self.volatility = volatility
+        self.seed = seed or 0
+        self._walks = {}
+
+    def bars(self, symbol, full=False, timeout=None):
+        """Yield made up 1 minute bars of symbol for the last day (or month if full), oldest first."""
+        symbol = symbol.upper()
+        if not ticker.fullmatch(symbol):
+            return
+        minutes = 30 * 24 * 60 if full else 24 * 60
+        now = int(time.time()) // 60 * 60
+        walk = random.Random(zlib.crc32(symbol.encode()) ^ self.seed)
+        price = self.start * walk.uniform(0.2, 3)
+        for minute in range(minutes, 0, -1):
+            ts = now - minute * 60
+            bar = random.Random(zlib.crc32(symbol.encode()) ^ self.seed ^ ts)
+            close = max(round(price * (1 + bar.gauss(0, self.volatility)), 2), 0.01)
+            high, low = max(price, close) * (1 + bar.random() / 200), min(price, close) * (1 - bar.random() / 200)
+            yield (time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts)), price, round(high, 2), round(low, 2), close,
+                   bar.randint(100, 10000))
+            price = close
+
+    def quote(self, symbol, timeout=None):
+        """Return the next step of the random walk of symbol."""
+        self._simulate(timeout)
+        symbol = symbol.upper()
+        if not ticker.fullmatch(symbol):
+            return None
+
+        with self._lock:
+
+            # Every symbol gets its own generator, seeded from its name so runs are reproducible
+            if symbol not in self._walks:
+                walk = random.Random(zlib.crc32(symbol.encode()) ^ self.seed)
+                self._walks[symbol] = [walk, self.start * walk.uniform(0.2, 3)]
+            walk, price = self._walks[symbol]
+
+            # Take a step, keeping the price positive and at cent precision
+            price = max(round(price * (1 + walk.gauss(0, self.volatility)), 2), 0.01)
+            self._walks[symbol][1] = price
+        return {
+            "price": price,
+            "symbol": symbol
+        }
+
+
+def make_provider(name=QUOTE_PROVIDER):
+    """Build the quote provider called name, configured from the environment."""
+    options = {"latency": QUOTE_LATENCY, "failure_rate": QUOTE_FAILURE_RATE, "seed": QUOTE_SEED}
+    if name == "alphavantage":
+        return AlphaVantageProvider()
+    if name == "replay":
+        if not QUOTE_FIXTURE:
+            raise RuntimeError("QUOTE_FIXTURE not set")
+        return ReplayProvider(QUOTE_FIXTURE, **options)
+    if name == "randomwalk":
+        return RandomWalkProvider(**options)
+    raise RuntimeError(f"Unknown QUOTE_PROVIDER {name}")
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+
+from database import Database
+
+
+# SQLite file where the quotes shared by every worker process are kept. Empty disables it
+QUOTE_STORE = os.environ.get("QUOTE_STORE", "quotes.db")
+
+# Seconds a quote is kept in the store, and maximum number of symbols kept
+QUOTE_RETENTION = float(os.environ.get("QUOTE_RETENTION", 24 * 60 * 60))
+QUOTE_STORE_SIZE = int(os.environ.get("QUOTE_STORE_SIZE", 10000))
+
+# Seconds between two prunes of old quotes
+PRUNE_INTERVAL = 60
+
+# SQLite limits the number of parameters of a statement, so bulk reads are split
+CHUNK = 500
+
+# Created by every connection if missing
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS quotes (
+        symbol TEXT PRIMARY KEY NOT NULL,
+        price REAL NOT NULL,
+        fetched_at REAL NOT NULL,
+        source TEXT NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS quotes_fetched_at ON quotes (fetched_at)"
+]
+
+
+class QuoteStore:
+    """
+    Quotes shared by every worker process through a SQLite file.
+
+    Every thread gets its own connection, through a Database. Writes are upserts that
+    never replace a quote with an older one, so concurrent writers can't go back in time.
+    """
+
+    def __init__(self, path=QUOTE_STORE, retention=QUOTE_RETENTION, maxsize=QUOTE_STORE_SIZE):
+        self.path = path
+        self.retention = retention
+        self.maxsize = maxsize
+        self.hits = self.misses = self.writes = 0
+        self.db = Database(path, schema=SCHEMA)
+        self._pruned = time.time()
+        self._lock = threading.Lock()
+
+    def get(self, symbol, max_age=None):
+        """Return the stored quote for symbol, or None if missing or older than max_age seconds."""
+        return self.get_many([symbol], max_age).get(symbol)
+
+    def get_many(self, symbols, max_age=None):
+        """Return a dict mapping the symbols found in the store (and not too old) to their quotes."""
+        symbols = list(dict.fromkeys(symbols))
+        oldest = time.time() - (max_age if max_age is not None else self.retention)
+        found = {}
+        for i in range(0, len(symbols), CHUNK):
+            chunk = {f"s{n}": symbol for n, symbol in enumerate(symbols[i:i + CHUNK])}
+            for row in self.db.execute(f"""SELECT symbol, price, fetched_at, source FROM quotes
+                    WHERE symbol IN ({", ".join(":" + name for name in chunk)}) AND fetched_at >= :oldest""",
+                                       oldest=oldest, **chunk):
+                found[row["symbol"]] = row
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(symbols) - len(found)
+        return found
+
+    def put(self, quote, source, fetched_at=None):
+        """Store a quote, unless the store already has a newer one for the symbol."""
+        self.put_many([quote], source, fetched_at)
+
+    def put_many(self, quotes, source, fetched_at=None):
+        """Store several quotes at once, in a single transaction."""
+        fetched_at = fetched_at or time.time()
+        with self.db.transaction():
+            self.db.executemany(
+                """INSERT INTO quotes (symbol, price, fetched_at, source) VALUES (:symbol, :price, :fetched_at, :source)
+                ON CONFLICT(symbol) DO UPDATE SET
+                    price=excluded.price, fetched_at=excluded.fetched_at, source=excluded.source
+                WHERE excluded.fetched_at > quotes.fetched_at""",
+                [{"symbol": quote["symbol"], "price": quote["price"], "fetched_at": fetched_at, "source": source}
+                 for quote in quotes])
+        with self._lock:
+            self.writes += len(quotes)
+            prune = time.time() - self._pruned > PRUNE_INTERVAL
+            if prune:
+                self._pruned = time.time()
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """Delete quotes older than the retention, and the oldest ones beyond maxsize."""
+        with self.db.transaction():
+            self.db.execute("DELETE FROM quotes WHERE fetched_at < :oldest", oldest=time.time() - self.retention)
+            self.db.execute("""DELETE FROM quotes WHERE symbol IN
+                (SELECT symbol FROM quotes ORDER BY fetched_at DESC LIMIT -1 OFFSET :maxsize)""", maxsize=self.maxsize)
+
+    def stats(self):
+        """Return the store counters as a dict."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "writes": self.writes}
+
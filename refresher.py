@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import helpers
+
+from helpers import lookup
+
+
+# Seconds between two refreshes of every held symbol. Shorter than QUOTE_TTL, so quotes never go stale
+REFRESH_INTERVAL = float(os.environ.get("REFRESH_INTERVAL", 45))
+
+# Maximum quotes requested per minute, to stay within the API rate limits
+REFRESH_BUDGET = float(os.environ.get("REFRESH_BUDGET", 60))
+
+# Symbols refreshed together, and how many of them are fetched at the same time
+REFRESH_BATCH = int(os.environ.get("REFRESH_BATCH", 10))
+REFRESH_WORKERS = int(os.environ.get("REFRESH_WORKERS", 4))
+
+
+class PriceRefresher:
+    """
+    Background thread that keeps the quotes of every held symbol warm.
+
+    symbols is a callable returning the symbols to refresh, it is called again on
+    every cycle so new holdings are picked up.
+    """
+
+    def __init__(self, symbols, interval=REFRESH_INTERVAL, budget=REFRESH_BUDGET,
+                 batch=REFRESH_BATCH, workers=REFRESH_WORKERS):
+        self.symbols = symbols
+        self.interval = interval
+        self.budget = budget
+        self.batch = batch
+        self.workers = workers
+        self.cycles = self.refreshed = self.failed = 0
+        self.last_started = self.last_finished = self.last_error = None
+        self._tokens = batch
+        self._refilled = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start refreshing in a daemon thread."""
+        if self.running():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="price-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Ask the thread to stop, and wait for it to finish its current batch."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def running(self):
+        """Tell whether the refresher thread is alive."""
+        return bool(self._thread and self._thread.is_alive())
+
+    def status(self):
+        """Return the refresher counters as a dict. lag is the age of the oldest refreshed quote."""
+        with self._lock:
+            lag = None
+            if self.last_finished is not None:
+                lag = round(time.monotonic() - self.last_started, 3)
+            return {
+                "running": self.running(),
+                "cycles": self.cycles,
+                "refreshed": self.refreshed,
+                "failed": self.failed,
+                "lag": lag,
+                "last_error": self.last_error
+            }
+
+    def refresh(self, pool):
+        """Refresh every symbol once, in batches, without going over the budget."""
+        symbols = {symbol.upper() for symbol in self.symbols()}
+
+        # Skip the symbols another worker process refreshed recently
+        if helpers.quote_store:
+            symbols -= helpers.quote_store.get_many(symbols, max_age=self.interval / 2).keys()
+        symbols = sorted(symbols)
+        for i in range(0, len(symbols), self.batch):
+            if self._stop.is_set():
+                return False
+            batch = symbols[i:i + self.batch]
+            self._spend(len(batch))
+            quotes = list(pool.map(lambda symbol: lookup(symbol, refresh=True), batch))
+            with self._lock:
+                self.refreshed += sum(1 for quote in quotes if quote)
+                self.failed += sum(1 for quote in quotes if not quote)
+        return True
+
+    def _spend(self, n):
+        """Wait until n requests fit in the budget (a token bucket refilled at budget per minute)."""
+        rate = self.budget / 60
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._refilled) * rate, max(self.batch, n))
+            self._refilled = now
+            if self._tokens >= n or self._stop.is_set():
+                break
+            self._stop.wait((n - self._tokens) / rate)
+        self._tokens -= n
+
+    def _run(self):
+        """Refresh every interval until stopped."""
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="refresh") as pool:
+            while not self._stop.is_set():
+                started = time.monotonic()
+                try:
+                    complete = self.refresh(pool)
+                except Exception as e:
+                    complete = False
+                    with self._lock:
+                        self.last_error = repr(e)
+
+                # Only full cycles count, so the lag shows how old the oldest quote can be
+                if complete:
+                    with self._lock:
+                        self.cycles += 1
+                        self.last_started, self.last_finished = started, time.monotonic()
+                self._stop.wait(max(self.interval - (time.monotonic() - started), 0))
@@ -0,0 +1,166 @@
+"""
+Server-side sessions in a SQLite file shared by every worker process.
+
+The cookie only holds a random session id. Loading a session is one primary key
+read, and saving it only writes when its contents changed (or, at most every
+SESSION_TOUCH seconds, to push its expiration back). Sessions expire after
+SESSION_LIFETIME seconds without use, and a background thread deletes them.
+"""
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from database import Database
+
+
+# SQLite file where the sessions of every worker process are kept
+SESSION_STORE = os.environ.get("SESSION_STORE", "sessions.db")
+
+# Seconds a session lasts without being used
+SESSION_LIFETIME = float(os.environ.get("SESSION_LIFETIME", 24 * 60 * 60))
+
+# Seconds between two writes of an unchanged session, just to push its expiration back
+SESSION_TOUCH = float(os.environ.get("SESSION_TOUCH", 5 * 60))
+
+# Seconds between two deletions of the expired sessions
+SESSION_CLEANUP = float(os.environ.get("SESSION_CLEANUP", 10 * 60))
+
+# Created by every connection if missing
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS sessions (
+        sid TEXT PRIMARY KEY NOT NULL,
+        data TEXT NOT NULL,
+        expires REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)"
+]
+
+
+class StoredSession(CallbackDict, SessionMixin):
+    """A session loaded from the store, which knows whether it was changed."""
+
+    def __init__(self, initial=None, sid=None, expires=0.0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.modified = False
+        self.replaced = None
+
+    def clear(self):
+        """Empty the session. Whatever is stored next gets a new id, so an old cookie can't reach it."""
+        super().clear()
+        self.replaced = self.replaced or self.sid
+        self.sid = None
+
+
+class SessionStore:
+    """Session data by id in a SQLite table, through a Database (one connection per thread)."""
+
+    def __init__(self, path=SESSION_STORE):
+        self.path = path
+        self.db = Database(path, schema=SCHEMA)
+
+    def load(self, sid):
+        """Return the (data, expires) of the session, or None if there is none or it expired."""
+        rows = self.db.execute("SELECT data, expires FROM sessions WHERE sid=:sid AND expires > :now", sid=sid, now=time.time())
+        return (rows[0]["data"], rows[0]["expires"]) if rows else None
+
+    def save(self, sid, data, expires):
+        """Store the data of the session, replacing what it had."""
+        self.db.execute("""INSERT INTO sessions (sid, data, expires) VALUES (:sid, :data, :expires)
+            ON CONFLICT(sid) DO UPDATE SET data=excluded.data, expires=excluded.expires""", sid=sid, data=data, expires=expires)
+
+    def touch(self, sid, expires):
+        """Push the expiration of the session back, without rewriting its data."""
+        self.db.execute("UPDATE sessions SET expires=:expires WHERE sid=:sid", expires=expires, sid=sid)
+
+    def delete(self, sid):
+        """Forget the session."""
+        self.db.execute("DELETE FROM sessions WHERE sid=:sid", sid=sid)
+
+    def cleanup(self):
+        """Delete the expired sessions, returning how many."""
+        return self.db.execute("DELETE FROM sessions WHERE expires <= :now", now=time.time())
+
+    def count(self):
+        """Return the number of stored sessions, expired or not."""
+        return self.db.execute("SELECT COUNT(*) AS count FROM sessions")[0]["count"]
+
+
+class SqliteSessionInterface(SessionInterface):
+    """Flask session interface keeping the sessions in a SessionStore."""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store=None, lifetime=SESSION_LIFETIME, touch=SESSION_TOUCH, interval=SESSION_CLEANUP):
+        self.store = store or SessionStore()
+        self.lifetime = lifetime
+        self.touch = touch
+        self.interval = interval
+        self._cleaner = None
+        self._lock = threading.Lock()
+
+    def open_session(self, app, request):
+        """Load the session named by the cookie, or start an empty one."""
+        self._start_cleaner()
+        sid = request.cookies.get(self.get_cookie_name(app))
+        row = self.store.load(sid) if sid else None
+        if row is None:
+            return StoredSession()
+        data, expires = row
+        return StoredSession(self.serializer.loads(data), sid, expires)
+
+    def save_session(self, app, session, response):
+        """Write the session only if it changed (or needs its expiration pushed back), and set the cookie."""
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.sid or session.replaced:
+            response.vary.add("Cookie")
+
+        # A cleared session (logging in or out) is deleted, and so is its cookie if nothing replaces it
+        if session.replaced:
+            self.store.delete(session.replaced)
+            if not session:
+                response.delete_cookie(name, domain=domain, path=path)
+        if not session:
+            return
+
+        now = time.time()
+        if session.modified or not session.sid:
+            new = not session.sid
+            session.sid = session.sid or secrets.token_urlsafe(32)
+            self.store.save(session.sid, self.serializer.dumps(dict(session)), now + self.lifetime)
+            if new:
+                response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                    httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                    secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+        # An unchanged session is only written every so often, to keep it from expiring while in use
+        elif session.expires - now < self.lifetime - self.touch:
+            self.store.touch(session.sid, now + self.lifetime)
+
+    def _start_cleaner(self):
+        """Start the thread deleting the expired sessions, the first time a session is opened."""
+        if self._cleaner is not None:
+            return
+        with self._lock:
+            if self._cleaner is None:
+                self._cleaner = threading.Thread(target=self._clean, name="session-cleaner", daemon=True)
+                self._cleaner.start()
+
+    def _clean(self):
+        """Delete the expired sessions every interval seconds, forever."""
+        while True:
+
+            # A locked database just waits for the next round
+            try:
+                self.store.cleanup()
+            except sqlite3.Error:
+                pass
+            time.sleep(self.interval)
@@ -0,0 +1,160 @@
+"""
+Live prices pushed to browsers with server-sent events.
+
+One poller thread per process fetches every symbol somebody is subscribed to,
+once per STREAM_INTERVAL (bypassing the cache, which would only change them once
+per QUOTE_TTL), and fans the prices that changed out to the subscribers of each
+symbol. Upstream traffic depends on the number of distinct symbols, not on the
+number of connected clients.
+
+Every subscriber has a queue of at most STREAM_BUFFER events. A client too slow
+to keep up is dropped (its browser reconnects by itself) instead of making the
+poller wait or the queue grow.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from helpers import lookup_many
+
+
+# Seconds between two polls of the subscribed symbols
+STREAM_INTERVAL = float(os.environ.get("STREAM_INTERVAL", 5))
+
+# Events waiting for a client before it is considered too slow and dropped
+STREAM_BUFFER = int(os.environ.get("STREAM_BUFFER", 32))
+
+# Seconds without events after which a comment is sent, so proxies keep the connection open
+STREAM_HEARTBEAT = float(os.environ.get("STREAM_HEARTBEAT", 15))
+
+# Most symbols a client can subscribe to
+STREAM_SYMBOLS = int(os.environ.get("STREAM_SYMBOLS", 50))
+
+
+class Subscription:
+    """The queue of price events of one client, with room for a first price of every symbol."""
+
+    def __init__(self, symbols, size=STREAM_BUFFER):
+        self.symbols = symbols
+        self.events = queue.Queue(size + len(symbols))
+        self.dropped = False
+
+
+class PriceStream:
+    """
+    Shared poller of the subscribed symbols, fanning their price changes out to the subscriptions.
+
+    The polling thread starts with the first subscription, unless poller is False (then
+    poll() has to be called by hand).
+    """
+
+    def __init__(self, interval=STREAM_INTERVAL, buffer=STREAM_BUFFER, poller=True):
+        self.interval = interval
+        self.buffer = buffer
+        self.poller = poller
+        self.polls = self.published = self.drops = 0
+        self._subscribers = {}
+        self._prices = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def subscribe(self, symbols):
+        """Return a subscription to the prices of symbols, starting with the last known ones."""
+        subscription = Subscription(frozenset(symbol.upper() for symbol in symbols), self.buffer)
+        with self._lock:
+            for symbol in subscription.symbols:
+                self._subscribers.setdefault(symbol, set()).add(subscription)
+                if symbol in self._prices:
+                    subscription.events.put_nowait(self._prices[symbol])
+            if self.poller and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="price-stream", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop sending prices to the subscription."""
+        with self._lock:
+            self._remove(subscription)
+
+    def events(self, subscription, heartbeat=STREAM_HEARTBEAT):
+        """Yield the subscription's events in the text/event-stream format, until it is dropped."""
+        try:
+            while not subscription.dropped:
+                try:
+                    event = subscription.events.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: price\ndata: {json.dumps(event)}\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+    def status(self):
+        """Return the poller counters as a dict."""
+        with self._lock:
+            return {
+                "symbols": len(self._subscribers),
+                "subscriptions": len({s for subscribers in self._subscribers.values() for s in subscribers}),
+                "polls": self.polls,
+                "published": self.published,
+                "drops": self.drops
+            }
+
+    def poll(self):
+        """Fetch every subscribed symbol once, and publish the prices that changed."""
+        with self._lock:
+            symbols = list(self._subscribers)
+        if not symbols:
+            return
+        quotes = lookup_many(symbols, refresh=True)
+        now = time.time()
+        with self._lock:
+            self.polls += 1
+            for symbol, quote in quotes.items():
+                subscribers = self._subscribers.get(symbol)
+                if not quote or not subscribers:
+                    continue
+                if self._prices.get(symbol, {}).get("price") == quote["price"]:
+                    continue
+                event = self._prices[symbol] = {"symbol": symbol, "price": quote["price"], "time": now}
+                self.published += 1
+
+                # A full queue means the client isn't reading: drop it rather than wait for it
+                for subscription in list(subscribers):
+                    try:
+                        subscription.events.put_nowait(event)
+                    except queue.Full:
+                        self._drop(subscription)
+
+    def _drop(self, subscription):
+        """Stop the subscription of a client that doesn't keep up. Called with the lock held."""
+        subscription.dropped = True
+        self.drops += 1
+        self._remove(subscription)
+
+    def _remove(self, subscription):
+        """Forget the subscription, and the symbols nobody else is subscribed to. Called with the lock held."""
+        for symbol in subscription.symbols:
+            subscribers = self._subscribers.get(symbol)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[symbol]
+                    self._prices.pop(symbol, None)
+
+    def _run(self):
+        """Poll every interval seconds while there are subscribers, sleep until there are otherwise."""
+        while True:
+            with self._lock:
+                idle = not self._subscribers
+            if idle:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            started = time.monotonic()
+            self.poll()
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
@@ -0,0 +1,107 @@
+from datetime import datetime
+
+from portfolio import record_buy, record_sell
+
+
+class TradeError(Exception):
+    """The order can't be executed, the message says why."""
+
+
+def buy(db, u_id, symbol, shares, price, t):
+    """Buy shares of symbol at price for the user. Checks happen before any write."""
+
+    # Take the cost from the user's cash, only if they can afford it
+    cost = shares * price
+    if not db.execute("UPDATE users SET cash=cash - :cost WHERE id=:u_id AND cash >= :cost", cost=cost, u_id=u_id):
+        raise TradeError("u poor")
+
+    # Register the transaction, and add the shares to the user's stock (creating it if needed)
+    db.execute("""INSERT INTO transactions (id_user, symbol, shares, price, time) VALUES
+        (:u_id, :symbol, :shares, :price, :t)""", u_id=u_id, symbol=symbol, shares=shares, price=price, t=t)
+    db.execute("""INSERT INTO stocks (id_user, symbol, amount) VALUES (:u_id, :symbol, :shares)
+        ON CONFLICT(id_user, symbol) DO UPDATE SET amount=amount + excluded.amount""", u_id=u_id, symbol=symbol, shares=shares)
+    record_buy(db, u_id, symbol, shares, price, t)
+
+
+def sell(db, u_id, symbol, shares, price, t):
+    """Sell shares of symbol at price for the user. Checks happen before any write."""
+
+    # Take the shares from the user's stock, only if they have that many
+    if not db.execute("UPDATE stocks SET amount=amount - :shares WHERE id_user=:u_id AND symbol=:symbol AND amount >= :shares",
+                      shares=shares, u_id=u_id, symbol=symbol):
+        raise TradeError("you don't have that many")
+
+    # If the user sold all their shares, delete the register of them having stocks of this company
+    db.execute("DELETE FROM stocks WHERE id_user=:u_id AND symbol=:symbol AND amount=0", u_id=u_id, symbol=symbol)
+
+    # Register the transaction and add the money from the sell to their existences
+    db.execute("""INSERT INTO transactions (id_user, symbol, shares, price, time) VALUES
+        (:u_id, :symbol, :shares, :price, :t)""", u_id=u_id, symbol=symbol, shares=-shares, price=price, t=t)
+    db.execute("UPDATE users SET cash=cash + :proceeds WHERE id=:u_id", proceeds=shares * price, u_id=u_id)
+    record_sell(db, u_id, symbol, shares, price, t)
+
+
+def execute_order(db, u_id, symbol, shares, price):
+    """Execute a market order in a single transaction. Positive shares buy, negative shares sell."""
+    t = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with db.transaction():
+        if shares > 0:
+            buy(db, u_id, symbol, shares, price, t)
+        else:
+            sell(db, u_id, symbol, -shares, price, t)
+
+
+class BasketError(TradeError):
+    """Some orders of a basket can't be executed, so none was. results has the error of every order."""
+
+    def __init__(self, message, results):
+        super().__init__(message)
+        self.results = results
+
+
+def execute_basket(db, u_id, orders, prices, unknown=()):
+    """
+    Execute a basket of market orders all-or-nothing, in a single transaction.
+
+    orders are (symbol, shares) pairs, positive shares buy and negative shares sell,
+    and prices maps their symbols to prices. Symbols missing from prices are reported
+    as "symbol 404" if they are in unknown, as "price unavailable" otherwise. Sells go
+    first, so what they bring in can pay for the buys. Returns a dict per order, or
+    raises BasketError.
+    """
+    results = [{"symbol": symbol, "shares": shares, "price": prices.get(symbol), "error": None}
+               for symbol, shares in orders]
+    t = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with db.transaction():
+
+        # Read the holdings and cash inside the transaction, nobody can change them until it ends
+        held = {row["symbol"]: row["amount"]
+                for row in db.execute("SELECT symbol, amount FROM stocks WHERE id_user=:u_id", u_id=u_id)}
+        cash = db.execute("SELECT cash FROM users WHERE id=:u_id", u_id=u_id)[0]["cash"]
+
+        # Check the whole basket before writing anything: every sell against what is left of its
+        # holding after the previous sells, then every buy against the cash left after the sells
+        for result in sorted(results, key=lambda result: result["shares"] > 0):
+            if result["price"] is None:
+                result["error"] = "symbol 404" if result["symbol"] in unknown else "price unavailable"
+            elif result["shares"] < 0:
+                if held.get(result["symbol"], 0) < -result["shares"]:
+                    result["error"] = "you don't have that many"
+                else:
+                    held[result["symbol"]] += result["shares"]
+                    cash -= result["shares"] * result["price"]
+            else:
+                cash -= result["shares"] * result["price"]
+                if cash < 0:
+                    result["error"] = "u poor"
+        if any(result["error"] for result in results):
+            raise BasketError("no order of the basket was executed", results)
+
+        # The checks passed, so the guarded updates of buy() and sell() can only fail if the data is corrupt
+        for result in sorted(results, key=lambda result: result["shares"] > 0):
+            if result["shares"] > 0:
+                buy(db, u_id, result["symbol"], result["shares"], result["price"], t)
+            else:
+                sell(db, u_id, result["symbol"], -result["shares"], result["price"], t)
+            result["total"] = abs(result["shares"]) * result["price"]
+    return results